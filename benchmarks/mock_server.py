@@ -0,0 +1,233 @@
+"""Local stand-in for the Wahoo SYSTM GraphQL endpoint and the intervals.icu events API.
+
+Replays the recorded responses in benchmarks/fixtures, so suffersync can be benchmarked without live accounts.
+Run it on its own and point SYSTM_URL and INTERVALS_ICU_URL in suffersync.cfg at it, or use run_benchmark.py.
+"""
+import argparse
+import itertools
+import json
+import os
+import random
+import time
+from collections import Counter
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from urllib.parse import parse_qs, urlsplit
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+def read_fixture(name):
+    """Return recorded response from the fixtures directory."""
+    with open(os.path.join(FIXTURES_DIR, f'{name}.json'), encoding='utf-8') as f:
+        return json.load(f)
+
+
+def get_plan(plan_size, start_date):
+    """Return Wahoo SYSTM plan of plan_size workouts from start_date on, repeating the recorded plan."""
+    recorded = read_fixture('GetUserPlansRange')['data']['userPlan']
+    plan = []
+    for index in range(plan_size):
+        item = json.loads(json.dumps(recorded[index % len(recorded)]))
+        prospect = item['prospects'][0]
+        # Every repetition gets its own workout id, so workout details are fetched for the whole plan.
+        prospect['workoutId'] = f"{prospect['workoutId']}{index // len(recorded)}"
+        item['plannedDate'] = f'{start_date + timedelta(days=index)}T00:00:00.000Z'
+        plan.append(item)
+    return plan
+
+
+class MockState:
+    """Plan, workout details and intervals.icu events served by the mock server, with request counts per operation."""
+
+    def __init__(self, plan_size=100, latency=0.0, error_rate=0.0, start_date=None, seed=0):
+        self.start_date = start_date or date.today() + timedelta(days=1)
+        self.plan = get_plan(plan_size, self.start_date)
+        self.login = read_fixture('Login')
+        self.workouts = read_fixture('GetWorkouts')
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.events = {}
+        self.event_ids = itertools.count(1)
+        self.requests = Counter()
+        self.errors = Counter()
+        self.lock = Lock()
+
+    def reset_counts(self):
+        """Reset request and error counts, keeping the events."""
+        with self.lock:
+            self.requests.clear()
+            self.errors.clear()
+
+    def fail(self, operation):
+        """Return True if this request should fail with a 503 response."""
+        with self.lock:
+            self.requests[operation] += 1
+            failed = self.error_rate and self.random.random() < self.error_rate
+            if failed:
+                self.errors[operation] += 1
+        return failed
+
+    def graphql(self, body):
+        """Return response for a Wahoo SYSTM GraphQL request."""
+        operation = body.get('operationName')
+        variables = body.get('variables') or {}
+        if operation == 'Login':
+            return self.login
+        if operation == 'GetUserPlansRange':
+            start, end = variables['startDate'][:10], variables['endDate'][:10]
+            limit = (variables.get('queryParams') or {}).get('limit') or len(self.plan)
+            items = [item for item in self.plan if start <= item['plannedDate'][:10] <= end]
+            return {'data': {'userPlan': items[:limit]}}
+        if operation == 'GetWorkouts':
+            workout_id = variables['id']
+            # Strip the repetition number added by get_plan() to find the recorded workout.
+            recorded = next((value for key, value in self.workouts.items() if workout_id.startswith(key)), None)
+            if recorded is None:
+                return {'data': {'workouts': []}}
+            response = json.loads(json.dumps(recorded))
+            response['data']['workouts'][0]['id'] = workout_id
+            return response
+        return {'errors': [{'message': f'Unknown operation {operation}'}]}
+
+    def add_event(self, payload):
+        """Create event, or update the event with the same external id. Return the event."""
+        with self.lock:
+            event_id = None
+            if payload.get('external_id'):
+                event_id = next((key for key, event in self.events.items() if event.get('external_id') == payload['external_id']), None)
+            if event_id is None:
+                event_id = next(self.event_ids)
+            event = dict(payload, id=event_id)
+            event['name'] = payload.get('name') or payload.get('filename', '').rsplit('.', 1)[0].replace('_', ' ')
+            event.pop('file_contents', None)
+            self.events[event_id] = event
+            return event
+
+    def list_events(self, oldest, newest):
+        """Return events between the oldest and newest date."""
+        with self.lock:
+            return [event for event in self.events.values() if oldest <= event['start_date_local'][:10] <= newest]
+
+    def delete_events(self, event_ids):
+        """Delete events, return the number of deleted events."""
+        with self.lock:
+            return sum(self.events.pop(int(event_id), None) is not None for event_id in event_ids)
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    """Handle Wahoo SYSTM and intervals.icu requests using the MockState of the server."""
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, don't let Nagle's algorithm delay the body.
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, data, status=200, headers=None):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_json(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length)) if length else None
+
+    def handle_request(self, method):
+        state = self.server.state
+        url = urlsplit(self.path)
+        body = self.read_json()
+        parts = url.path.strip('/').split('/')
+        if parts[-1] == 'graphql':
+            operation = (body or {}).get('operationName', 'graphql')
+        elif parts[-1] == 'events':
+            operation = {'GET': 'GetEvents', 'POST': 'CreateEvent'}.get(method, method)
+        elif parts[-1] == 'bulk':
+            operation = 'BulkCreateEvents'
+        elif parts[-1] == 'bulk-delete':
+            operation = 'BulkDeleteEvents'
+        else:
+            operation = {'PUT': 'UpdateEvent', 'DELETE': 'DeleteEvent'}.get(method, method)
+
+        if state.latency:
+            time.sleep(state.latency)
+        if state.fail(operation):
+            self.send_json({'error': 'Service unavailable'}, 503, {'Retry-After': '0'})
+            return
+
+        if operation in ('Login', 'GetUserPlansRange', 'GetWorkouts', 'graphql'):
+            self.send_json(state.graphql(body or {}))
+        elif operation == 'GetEvents':
+            query = parse_qs(url.query)
+            self.send_json(state.list_events(query['oldest'][0], query['newest'][0]))
+        elif operation == 'CreateEvent':
+            self.send_json(state.add_event(body))
+        elif operation == 'BulkCreateEvents':
+            self.send_json([state.add_event(payload) for payload in body])
+        elif operation == 'BulkDeleteEvents':
+            self.send_json({'eventsDeleted': state.delete_events(event['id'] for event in body)})
+        elif operation == 'UpdateEvent':
+            event_id = int(parts[-1])
+            if event_id not in state.events:
+                self.send_json({'error': 'Not found'}, 404)
+                return
+            self.send_json(state.add_event(dict(state.events[event_id], **body)))
+        elif operation == 'DeleteEvent':
+            state.delete_events([parts[-1]])
+            self.send_json({})
+        else:
+            self.send_json({'error': 'Not found'}, 404)
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def do_PUT(self):
+        self.handle_request('PUT')
+
+    def do_DELETE(self):
+        self.handle_request('DELETE')
+
+
+def start_mock_server(state, port=0):
+    """Start mock server for state in a background thread, return the server and its base url."""
+    server = ThreadingHTTPServer(('127.0.0.1', port), MockHandler)
+    server.daemon_threads = True
+    server.state = state
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_port}'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=8080, help='Port to listen on.')
+    parser.add_argument('--plan-size', type=int, default=100, help='Number of workouts in the training plan.')
+    parser.add_argument('--latency', type=float, default=0, help='Delay of every response in milliseconds.')
+    parser.add_argument('--error-rate', type=float, default=0, help='Fraction of requests that fail with a 503 response.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for the failed requests.')
+    args = parser.parse_args()
+
+    state = MockState(args.plan_size, args.latency / 1000, args.error_rate, seed=args.seed)
+    server, url = start_mock_server(state, args.port)
+    end_date = state.start_date + timedelta(days=args.plan_size)
+    print(f'Serving {args.plan_size} workouts from {state.start_date} to {end_date}.')
+    print(f'SYSTM_URL = {url}/graphql')
+    print(f'INTERVALS_ICU_URL = {url}/api/v1')
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+"""Benchmark suffersync end to end against the local mock server, without live Wahoo SYSTM or intervals.icu accounts.
+
+Every scenario runs main() in a temporary directory and reports wall time, requests per API operation, the time
+spent in each stage of the sync and workout cache hits. Scenarios run in order and share cache, sync state and
+intervals.icu events:
+
+- cold: nothing cached or uploaded yet
+- warm: second sync, workout details are cached and nothing changed
+- force: everything is converted and uploaded again with -f
+
+Example: python benchmarks/run_benchmark.py --plan-size 200 --latency 50 --json benchmark.json
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+from datetime import timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import suffersync  # noqa: E402
+from mock_server import MockState, start_mock_server  # noqa: E402
+
+# Stages of the sync timed by suffersync, in the order they're reported.
+STAGES = ('login', 'plan', 'events', 'detail', 'render', 'delete', 'upload')
+SCENARIOS = {
+    'cold': [],
+    'warm': [],
+    'force': ['-f'],
+}
+
+
+def write_config(url, state, args):
+    """Write suffersync.cfg that syncs all workouts of the mock server."""
+    end_date = state.start_date + timedelta(days=len(state.plan))
+    with open('suffersync.cfg', 'w', encoding='utf-8') as f:
+        f.write(f"""[DEFAULT]
+UPLOAD_RUN_WORKOUTS = 1
+UPLOAD_SWIM_WORKOUTS = 1
+UPLOAD_STRENGTH_WORKOUTS = 1
+UPLOAD_YOGA_WORKOUTS = 1
+UPLOAD_DESCRIPTION = 1
+BULK_UPLOAD_SIZE = {args.bulk_upload_size}
+MAX_CONCURRENT_REQUESTS = {args.concurrency}
+HTTP_RATE_LIMIT = {args.rate_limit}
+SYSTM_URL = {url}/graphql
+INTERVALS_ICU_URL = {url}/api/v1
+
+[WAHOO]
+SYSTM_USERNAME = benchmark
+SYSTM_PASSWORD = benchmark
+START_DATE = {state.start_date}
+END_DATE = {end_date}
+
+[INTERVALS.ICU]
+INTERVALS_ICU_ID = i0
+INTERVALS_ICU_APIKEY = benchmark
+""")
+
+
+def run_scenario(name, argv, state, verbose=False):
+    """Run main() with argv and return wall time, requests and stage timings."""
+    state.reset_counts()
+    sys.argv = ['suffersync', *argv]
+    output = io.StringIO()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(sys.stdout if verbose else output):
+        try:
+            suffersync.main()
+        except SystemExit as err:
+            if err.code:
+                print(output.getvalue(), file=sys.stderr)
+                raise
+    wall = time.perf_counter() - start
+    with suffersync.api_stats_lock:
+        client = {operation: dict(item) for operation, item in suffersync.api_stats.items()}
+        stages = {stage: dict(item) for (athlete, stage), item in suffersync.stage_stats.items()}
+        cache = dict(suffersync.cache_stats)
+    return {
+        'name': name,
+        'wall_seconds': wall,
+        'requests': dict(state.requests),
+        'errors': dict(state.errors),
+        'retried': sum(item['retried'] for item in client.values()),
+        'stages': stages,
+        'cache': cache,
+    }
+
+
+def run_benchmark(args):
+    """Run all scenarios repeat times in fresh directories, return the results of every run."""
+    runs = []
+    cwd = os.getcwd()
+    for repeat in range(args.repeat):
+        state = MockState(args.plan_size, args.latency / 1000, args.error_rate, seed=args.seed + repeat)
+        server, url = start_mock_server(state)
+        try:
+            with tempfile.TemporaryDirectory() as directory:
+                os.chdir(directory)
+                write_config(url, state, args)
+                extra = (['--async'] if args.use_async else []) + ([] if args.files else ['--no-files'])
+                runs.append([run_scenario(name, SCENARIOS[name] + extra, state, args.verbose) for name in args.scenarios])
+        finally:
+            os.chdir(cwd)
+            server.shutdown()
+            server.server_close()
+    return runs
+
+
+def summarize(runs):
+    """Return results of the run with the median wall time for every scenario."""
+    summary = []
+    for results in zip(*runs):
+        ordered = sorted(results, key=lambda result: result['wall_seconds'])
+        median = dict(ordered[(len(ordered) - 1) // 2])
+        median['wall_seconds_all'] = [result['wall_seconds'] for result in results]
+        median['wall_seconds_stdev'] = statistics.pstdev(median['wall_seconds_all'])
+        summary.append(median)
+    return summary
+
+
+def print_summary(summary):
+    """Print wall time, requests and stage timings per scenario."""
+    for result in summary:
+        requests = sum(result['requests'].values())
+        print(f"{result['name']}: {result['wall_seconds']:.2f}s, {requests} requests, {sum(result['errors'].values())} errors, {result['retried']} retried, {result['cache']['hits']} cache hits")
+        for operation, count in sorted(result['requests'].items()):
+            print(f"  {operation}: {count} requests")
+        for stage in STAGES:
+            item = result['stages'].get(stage)
+            if item:
+                print(f"  stage {stage}: {item['calls']} calls, {item['seconds']:.3f}s (slowest {item['max_seconds']:.3f}s)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--plan-size', type=int, default=100, help='Number of workouts in the training plan.')
+    parser.add_argument('--latency', type=float, default=20, help='Delay of every mock server response in milliseconds.')
+    parser.add_argument('--error-rate', type=float, default=0, help='Fraction of requests that fail with a 503 response.')
+    parser.add_argument('--concurrency', type=int, default=4, help='MAX_CONCURRENT_REQUESTS used by suffersync.')
+    parser.add_argument('--bulk-upload-size', type=int, default=50, help='BULK_UPLOAD_SIZE used by suffersync.')
+    parser.add_argument('--rate-limit', type=float, default=0, help='HTTP_RATE_LIMIT used by suffersync, 0 for no limit.')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help=f"Comma separated scenarios to run: {', '.join(SCENARIOS)}.")
+    parser.add_argument('--repeat', type=int, default=1, help='Run all scenarios this many times and report the median.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for the failed requests.')
+    parser.add_argument('--async', dest='use_async', action='store_true', help='Run suffersync with --async.')
+    parser.add_argument('--files', action='store_true', help='Store the .zwo files, they are skipped by default.')
+    parser.add_argument('--json', help='Write the results to this file.')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Show the output of suffersync.')
+    args = parser.parse_args()
+    args.scenarios = [name.strip() for name in args.scenarios.split(',')]
+    unknown = [name for name in args.scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"Unknown scenarios: {', '.join(unknown)}")
+
+    summary = summarize(run_benchmark(args))
+    print_summary(summary)
+    if args.json:
+        settings = {key: value for key, value in vars(args).items() if key not in ('json', 'verbose')}
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'settings': settings, 'python': sys.version.split()[0], 'scenarios': summary}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
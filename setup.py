@@ -17,9 +17,14 @@ setup(
     author_email='',
     license='MIT',
     py_modules=['suffersync'],
+    python_requires='>=3.9',
     install_requires=[
-        'requests>=2.26'
+        'requests>=2.26',
+        'urllib3>=1.26'
     ],
+    extras_require={
+        'fast': ['msgspec>=0.18', 'orjson>=3.9']
+    },
     entry_points={
         'console_scripts': [
             'suffersync=suffersync:main',
@@ -1,14 +1,177 @@
 import argparse
+import asyncio
 import configparser
+import gzip
+import hashlib
 import json
 import os
 import re
+import sqlite3
 import sys
-from base64 import b64encode
-from datetime import datetime
+import time
+from base64 import b64encode, urlsafe_b64decode
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextvars import ContextVar
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+from functools import wraps
+from threading import Event, Lock, get_ident
+from typing import Any, Dict, List
+from urllib.parse import urlsplit
 from xml.sax.saxutils import escape as escape_xml
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Faster JSON decoders are used when installed (pip install suffersync[fast]), otherwise the json module.
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+if orjson is not None:
+    json_loads = orjson.loads
+elif msgspec is not None:
+    json_loads = msgspec.json.decode
+else:
+    json_loads = json.loads
+
+# GraphQL queries per profile, 'minimal' only requests the fields suffersync uses.
+SYSTM_QUERIES = {
+    'full': {
+        'Login': "mutation Login($appInformation: AppInformation!, $username: String!, $password: String!) { loginUser(appInformation: $appInformation, username: $username, password: $password) { status message user { ...User_fragment __typename } token failureId __typename }}fragment User_fragment on User { id fullName firstName lastName email gender birthday weightKg heightCm createdAt metric emailSharingOn legacyThresholdPower wahooId wheelSize { name id __typename } updatedAt profiles { riderProfile { ...UserProfile_fragment __typename } __typename } connectedServices { name __typename } timeZone onboardingProgress { complete completedSteps __typename } subscription { validUntil trialAvailable __typename } avatar { url original { url __typename } square200x200 { url __typename } square256x256 { url __typename } thumb { url __typename } __typename } onboardingComplete createdWithAppInformation { version platform __typename } __typename}fragment UserProfile_fragment on UserProfile { nm ac map ftp lthr cadenceThreshold riderTypeInfo { name icon iconSmall systmIcon description __typename } riderWeaknessInfo { name __typename } recommended { nm { value activity __typename } ac { value activity __typename } map { value activity __typename } ftp { value activity __typename } __typename } __typename}",
+        'GetUserPlansRange': "query GetUserPlansRange($startDate: Date, $endDate: Date, $queryParams: QueryParams) { userPlan(startDate: $startDate, endDate: $endDate, queryParams: $queryParams) { ...UserPlanItem_fragment __typename }}fragment UserPlanItem_fragment on UserPlanItem { day plannedDate rank agendaId status type appliedTimeZone completionData { name date activityId durationSeconds style deleted __typename } prospects { type name compatibility description style intensity { master nm ac map ftp __typename } trainerSetting { mode level __typename } plannedDuration durationType metrics { ratings { nm ac map ftp __typename } __typename } contentId workoutId notes fourDPWorkoutGraph { time value type __typename } __typename } plan { id name color deleted durationDays startDate endDate addons level subcategory weakness description category grouping option uniqueToPlan type progression planDescription volume __typename } __typename}",
+        'GetWorkouts': "query GetWorkouts($id: ID) {workouts(id: $id) { id sortOrder sport stampImage bannerImage bestFor equipment { name description thumbnail __typename } details shortDescription level durationSeconds name triggers featuredRaces { name thumbnail darkBackgroundThumbnail __typename } metrics { intensityFactor tss ratings { nm ac map ftp __typename } __typename } brand nonAppWorkout notes tags imperatives { userSettings { birthday gender weight __typename } __typename } __typename}}"
+    },
+    'minimal': {
+        'Login': "mutation Login($appInformation: AppInformation!, $username: String!, $password: String!) { loginUser(appInformation: $appInformation, username: $username, password: $password) { status message user { profiles { riderProfile { nm ac map ftp } } } token failureId }}",
+        'GetUserPlansRange': "query GetUserPlansRange($startDate: Date, $endDate: Date, $queryParams: QueryParams) { userPlan(startDate: $startDate, endDate: $endDate, queryParams: $queryParams) { plannedDate prospects { type name description plannedDuration workoutId } }}",
+        'GetWorkouts': "query GetWorkouts($id: ID) {workouts(id: $id) { id details triggers }}"
+    }
+}
+# Base url of the intervals.icu API, overridden from suffersync.cfg by configure_intervals_icu().
+INTERVALS_ICU_SETTINGS = {'url': 'https://intervals.icu/api/v1'}
+# Wahoo SYSTM settings, overridden from suffersync.cfg by configure_systm().
+SYSTM_SETTINGS = {'query_profile': 'minimal'}
+# Connection settings used by call_api(), overridden from suffersync.cfg by configure_http().
+HTTP_SETTINGS = {'pool_size': 10, 'timeout': 30.0, 'retries': 3, 'backoff': 0.5, 'rate_limit': 10.0, 'burst': 10}
+# Responses that are retried by call_api(), 429 and 503 mean the host is throttling requests.
+RETRY_STATUS = (429, 500, 502, 503, 504)
+THROTTLE_STATUS = (429, 503)
+# Longest Retry-After that is honoured, in seconds.
+MAX_RETRY_AFTER = 120
+# Number of requests, bytes received, seconds spent, throttled and retried requests per API operation.
+api_stats = {}
+api_stats_lock = Lock()
+# Number of calls and seconds spent per athlete and stage of the sync, and workout cache hits and misses.
+stage_stats = {}
+cache_stats = {'hits': 0, 'misses': 0}
+# Keep-alive sessions and rate limiters per host, shared by all API calls.
+http_sessions = {}
+rate_limiters = {}
+http_sessions_lock = Lock()
+# Serializes updates of the token file and the --diff file when athletes are synced in parallel.
+token_file_lock = Lock()
+diff_file_lock = Lock()
+# Name of the athlete that's being synced by the current thread or task, added to log messages.
+log_athlete = ContextVar('log_athlete', default=None)
+
+
+class SystmError(Exception):
+    """Raised when Wahoo SYSTM returns an error for a plan request."""
+
+
+class SystmAuthError(SystmError):
+    """Raised when Wahoo SYSTM rejects the API token."""
+
+
+# GraphQL error codes and messages of Wahoo SYSTM for an invalid or expired token, other errors aren't retried.
+SYSTM_AUTH_ERROR_CODES = ('UNAUTHENTICATED', 'UNAUTHORIZED', 'FORBIDDEN')
+SYSTM_AUTH_ERROR_MESSAGES = ('not authorized', 'unauthorized', 'not authenticated', 'unauthenticated', 'jwt expired', 'invalid token')
+
+
+class RateLimiter:
+    """Token bucket for the requests to a host, slows down when the host starts throttling requests."""
+
+    def __init__(self, rate, burst):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = Lock()
+
+    def acquire(self):
+        """Wait until a request can be sent, return the number of seconds waited."""
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now >= self.paused_until:
+                    if not self.rate:
+                        return waited
+                    self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return waited
+                    delay = (1 - self.tokens) / self.rate
+                else:
+                    delay = self.paused_until - now
+            time.sleep(delay)
+            waited += delay
+
+    def throttle(self, delay):
+        """Pause all requests to the host for delay seconds and halve the request rate."""
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + delay)
+            # Start with an empty bucket after the pause instead of a burst of requests.
+            self.tokens = 0.0
+            self.updated = self.paused_until
+            if self.rate:
+                self.rate = max(self.max_rate / 16, self.rate / 2)
+
+    def recover(self):
+        """Raise the request rate step by step after a successful request, up to the configured rate."""
+        with self.lock:
+            if self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+
+def log(message):
+    """Print message, prefixed with the athlete name when syncing multiple athletes."""
+    athlete = log_athlete.get()
+    print(f'[{athlete}] {message}' if athlete else message)
+
+
+def timed(stage):
+    """Decorator that adds the calls of a function to the statistics of a sync stage."""
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                record_stage(stage, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+def record_stage(stage, elapsed):
+    """Add call of a sync stage to the statistics of the current athlete."""
+    with api_stats_lock:
+        stats = stage_stats.setdefault((log_athlete.get() or '', stage), {'calls': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+        stats['calls'] += 1
+        stats['seconds'] += elapsed
+        stats['max_seconds'] = max(stats['max_seconds'], elapsed)
 
 
 def write_configfile(config, filename):
@@ -24,6 +187,38 @@ UPLOAD_YOGA_WORKOUTS = 0
 # Change this to 1 if you want to upload past SYSTM workouts to intervals.icu
 UPLOAD_PAST_WORKOUTS = 0
 UPLOAD_DESCRIPTION = 0
+# Number of workouts uploaded to intervals.icu per request
+BULK_UPLOAD_SIZE = 50
+# Maximum number of Wahoo SYSTM workout details and plan windows fetched in parallel
+MAX_CONCURRENT_REQUESTS = 4
+# The training plan is fetched in windows of this number of days
+PLAN_WINDOW_DAYS = 31
+# Maximum number of athletes synced in parallel, see the [ATHLETE <name>] example below
+MAX_CONCURRENT_ATHLETES = 2
+# Fields requested from Wahoo SYSTM: minimal (only what suffersync uses) or full
+QUERY_PROFILE = minimal
+# Connection pool size per host, request timeout in seconds and retries on rate limiting (429) or server errors (5xx)
+HTTP_POOL_SIZE = 10
+HTTP_TIMEOUT = 30
+HTTP_RETRIES = 3
+HTTP_BACKOFF = 0.5
+# Maximum requests per second and burst size per host, 0 for no limit. The rate is lowered automatically when a host throttles requests.
+HTTP_RATE_LIMIT = 10
+HTTP_RATE_BURST = 10
+# Directory for cached Wahoo SYSTM workout details, cached workouts older than CACHE_TTL_DAYS are downloaded again
+CACHE_DIR = cache
+CACHE_TTL_DAYS = 30
+CACHE_MAX_SIZE_MB = 50
+# Database that keeps track of uploaded workouts, so unchanged workouts aren't uploaded again
+STATE_FILE = suffersync.db
+# File with the Wahoo SYSTM login token and 4DP profile, reused for TOKEN_TTL_HOURS or until the token expires if that's sooner
+TOKEN_FILE = suffersync.token
+TOKEN_TTL_HOURS = 24
+# Directory where a copy of the generated .zwo files is stored
+ZWO_DIR = zwo
+# API endpoints, only change these to run against a local test server such as benchmarks/mock_server.py
+# SYSTM_URL = https://api.thesufferfest.com/graphql
+# INTERVALS_ICU_URL = https://intervals.icu/api/v1
 
 [WAHOO]
 # Your Wahoo SYSTM credentials
@@ -39,6 +234,17 @@ END_DATE = 2023-12-31
 # Your intervals.icu API ID and API key
 INTERVALS_ICU_ID = i00000
 INTERVALS_ICU_APIKEY = xxxxxxxxxxxxx
+
+# To sync multiple athletes, replace the [WAHOO] and [INTERVALS.ICU] sections with one section per athlete.
+# The UPLOAD_* settings from [DEFAULT] can be changed per athlete as well.
+# [ATHLETE alice]
+# SYSTM_USERNAME = alice_systm_username
+# SYSTM_PASSWORD = alice_systm_password
+# START_DATE = 2023-09-01
+# END_DATE = 2023-12-31
+# INTERVALS_ICU_ID = i00001
+# INTERVALS_ICU_APIKEY = xxxxxxxxxxxxx
+# UPLOAD_RUN_WORKOUTS = 1
 """
     with open(filename, 'w', encoding="utf-8") as configfile:
         configfile.write(text)
@@ -63,7 +269,7 @@ def get_intervals_sport(sport):
 
 
 def get_systm_token(url, username, password):
-    """Returns Wahoo SYSTM API token."""
+    """Returns Wahoo SYSTM API token and 4DP profile of the rider."""
     payload = json.dumps({
         "operationName": "Login",
         "variables": {
@@ -75,32 +281,111 @@ def get_systm_token(url, username, password):
             "username": username,
             "password": password
         },
-        "query": "mutation Login($appInformation: AppInformation!, $username: String!, $password: String!) { loginUser(appInformation: $appInformation, username: $username, password: $password) { status message user { ...User_fragment __typename } token failureId __typename }}fragment User_fragment on User { id fullName firstName lastName email gender birthday weightKg heightCm createdAt metric emailSharingOn legacyThresholdPower wahooId wheelSize { name id __typename } updatedAt profiles { riderProfile { ...UserProfile_fragment __typename } __typename } connectedServices { name __typename } timeZone onboardingProgress { complete completedSteps __typename } subscription { validUntil trialAvailable __typename } avatar { url original { url __typename } square200x200 { url __typename } square256x256 { url __typename } thumb { url __typename } __typename } onboardingComplete createdWithAppInformation { version platform __typename } __typename}fragment UserProfile_fragment on UserProfile { nm ac map ftp lthr cadenceThreshold riderTypeInfo { name icon iconSmall systmIcon description __typename } riderWeaknessInfo { name __typename } recommended { nm { value activity __typename } ac { value activity __typename } map { value activity __typename } ftp { value activity __typename } __typename } __typename}"
+        "query": SYSTM_QUERIES[SYSTM_SETTINGS['query_profile']]['Login']
     })
 
     headers = {'Content-Type': 'application/json'}
 
-    response = call_api(url, "POST", headers, payload)
+    response = call_api(url, "POST", headers, payload, operation='Login')
     if 'login.badUserOrPassword' in response.text:
-        print('Invalid Wahoo SYSTM username or password. Please check your settings and try again.')
+        log('Invalid Wahoo SYSTM username or password. Please check your settings and try again.')
         sys.exit(1)
     response_json = response.json()
-    token = response_json['data']['loginUser']['token']
-    rider_profile = response_json['data']['loginUser']['user']['profiles']['riderProfile']
-    get_systm_profile(rider_profile)
-    return token
+    login = (response_json.get('data') or {}).get('loginUser') or {}
+    token = login.get('token')
+    user = login.get('user') or {}
+    rider_profile = (user.get('profiles') or {}).get('riderProfile')
+    # Failed logins come back with an empty token and user, 'status' and 'message' say why.
+    if not token or not rider_profile:
+        errors = response_json.get('errors') or [{}]
+        message = login.get('message') or login.get('failureId') or errors[0].get('message') or 'no token or rider profile returned'
+        log(f"Wahoo SYSTM login failed ({login.get('status') or 'error'}): {message}")
+        sys.exit(1)
+    return token, get_systm_profile(rider_profile)
 
 
 def get_systm_profile(profile):
-    """Get Wahoo SYSTM 4DP profile and set as global variables."""
-    global rider_ac, rider_nm, rider_map, rider_ftp
-    rider_ac = profile['ac']
-    rider_nm = profile['nm']
-    rider_map = profile['map']
-    rider_ftp = profile['ftp']
+    """Return Wahoo SYSTM 4DP profile of the rider."""
+    return {
+        'ac': profile['ac'],
+        'nm': profile['nm'],
+        'map': profile['map'],
+        'ftp': profile['ftp']
+    }
+
+
+def get_token_expiry(token, ttl_hours):
+    """Return time until which token and 4DP profile are reused: ttl_hours from now, or earlier if the token is a JWT that expires sooner."""
+    # The 4DP profile is cached with the token, so don't keep it longer than ttl_hours even if the token is still valid.
+    expiry = time.time() + ttl_hours * 3600
+    try:
+        claims = token.split('.')[1]
+        claims = json.loads(urlsafe_b64decode(claims + '=' * (-len(claims) % 4)))
+        return min(float(claims['exp']), expiry)
+    except (IndexError, ValueError, KeyError, TypeError):
+        return expiry
+
+
+def read_token_file(filename):
+    """Return cached Wahoo SYSTM logins by username."""
+    try:
+        with open(filename, 'r', encoding='utf-8') as f:
+            logins = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return logins if isinstance(logins, dict) else {}
 
 
-def get_systm_workouts(url, token, start_date, end_date):
+def write_token_file(filename, logins):
+    """Store cached Wahoo SYSTM logins, readable by the current user only. Errors are logged and ignored."""
+    temp_filename = f'{filename}.{os.getpid()}.{get_ident()}.tmp'
+    try:
+        fd = os.open(temp_filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(logins, f)
+        os.replace(temp_filename, filename)
+    except OSError as err:
+        log(f'Could not store the Wahoo SYSTM login in {filename}: {err}')
+        try:
+            os.remove(temp_filename)
+        except OSError:
+            pass
+
+
+@timed('login')
+def get_systm_login(url, username, password, token_file, ttl_hours, refresh=False):
+    """Return Wahoo SYSTM API token and 4DP profile, reusing a cached token until it expires."""
+    if not refresh:
+        with token_file_lock:
+            login = read_token_file(token_file).get(username)
+        # Keep a minute of margin, so the token doesn't expire halfway through the sync. Malformed entries log in again.
+        if isinstance(login, dict) and login.get('token') and login.get('profile'):
+            try:
+                if float(login.get('expires', 0)) > time.time() + 60:
+                    return login['token'], login['profile']
+            except (TypeError, ValueError):
+                pass
+
+    token, profile = get_systm_token(url, username, password)
+    with token_file_lock:
+        logins = read_token_file(token_file)
+        logins[username] = {'token': token, 'profile': profile, 'expires': get_token_expiry(token, ttl_hours)}
+        write_token_file(token_file, logins)
+    return token, profile
+
+
+def is_systm_auth_error(errors):
+    """Return True if Wahoo SYSTM GraphQL errors are caused by an invalid or expired token."""
+    for error in errors:
+        code = str((error.get('extensions') or {}).get('code', '')).upper()
+        message = str(error.get('message', '')).strip().rstrip('.').lower()
+        if code in SYSTM_AUTH_ERROR_CODES or message in SYSTM_AUTH_ERROR_MESSAGES:
+            return True
+    return False
+
+
+@timed('plan')
+def get_systm_workouts(url, token, start_date, end_date, limit=1000):
     """Get Wahoo SYSTM workouts for specified date range and return response."""
     payload = json.dumps({
         "operationName": "GetUserPlansRange",
@@ -108,10 +393,10 @@ def get_systm_workouts(url, token, start_date, end_date):
             "startDate": f"{start_date}T00:00:00.000Z",
             "endDate": f"{end_date}T23:59:59.999Z",
             "queryParams": {
-                "limit": 1000
+                "limit": limit
             }
         },
-        "query": "query GetUserPlansRange($startDate: Date, $endDate: Date, $queryParams: QueryParams) { userPlan(startDate: $startDate, endDate: $endDate, queryParams: $queryParams) { ...UserPlanItem_fragment __typename }}fragment UserPlanItem_fragment on UserPlanItem { day plannedDate rank agendaId status type appliedTimeZone completionData { name date activityId durationSeconds style deleted __typename } prospects { type name compatibility description style intensity { master nm ac map ftp __typename } trainerSetting { mode level __typename } plannedDuration durationType metrics { ratings { nm ac map ftp __typename } __typename } contentId workoutId notes fourDPWorkoutGraph { time value type __typename } __typename } plan { id name color deleted durationDays startDate endDate addons level subcategory weakness description category grouping option uniqueToPlan type progression planDescription volume __typename } __typename}"
+        "query": SYSTM_QUERIES[SYSTM_SETTINGS['query_profile']]['GetUserPlansRange']
     })
 
     headers = {
@@ -120,15 +405,73 @@ def get_systm_workouts(url, token, start_date, end_date):
     }
 
     # Get workouts from Wahoo SYSTM plan
-    response = call_api(url, "POST", headers, payload).json()
+    try:
+        response = call_api(url, "POST", headers, payload, operation='GetUserPlansRange').json()
+    except requests.HTTPError as err:
+        if err.response is not None and err.response.status_code in (401, 403):
+            raise SystmAuthError(str(err))
+        raise
 
     # Even with errors, response.status_code comes back as 200 so catching errors this way.
     if 'errors' in response:
-        print(f'Wahoo SYSTM Error: {response["errors"][0]["message"]}')
-        sys.exit(1)
+        if is_systm_auth_error(response['errors']):
+            raise SystmAuthError(response['errors'][0].get('message'))
+        # Plan windows are fetched in parallel, the caller reports the error once.
+        raise SystmError(response['errors'][0].get('message'))
     return response
 
 
+def split_date_range(start_date, end_date, days):
+    """Return (start, end) dates in YYYY-MM-DD format for windows of at most days between start_date and end_date."""
+    start = datetime.strptime(start_date, '%Y-%m-%d').date()
+    end = datetime.strptime(end_date, '%Y-%m-%d').date()
+    windows = []
+    while start <= end:
+        window_end = min(start + timedelta(days=max(1, days) - 1), end)
+        windows.append((str(start), str(window_end)))
+        start = window_end + timedelta(days=1)
+    return windows
+
+
+def iter_systm_workouts(url, token, start_date, end_date, window_days, max_workers, limit=1000):
+    """Get Wahoo SYSTM workouts in windows of window_days concurrently, yield (window start, workouts) as windows complete."""
+    athlete = log_athlete.get()
+
+    def fetch(window):
+        log_athlete.set(athlete)
+        return get_systm_workouts(url, token, window[0], window[1], limit)['data']['userPlan']
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        pending = {executor.submit(fetch, window): window for window in split_date_range(start_date, end_date, window_days)}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                window = pending.pop(future)
+                try:
+                    workouts = future.result()
+                except BaseException:
+                    # Don't fetch the remaining windows when one of them failed.
+                    for other in pending:
+                        other.cancel()
+                    raise
+                # A full response probably means workouts were cut off, fetch both halves of the window instead.
+                if len(workouts) >= limit and window[0] != window[1]:
+                    days = (datetime.strptime(window[1], '%Y-%m-%d') - datetime.strptime(window[0], '%Y-%m-%d')).days + 1
+                    for half in split_date_range(window[0], window[1], (days + 1) // 2):
+                        pending[executor.submit(fetch, half)] = half
+                    continue
+                if len(workouts) >= limit:
+                    log(f'More than {limit} workouts on {window[0]}, some workouts may be missing.')
+                yield window[0], workouts
+
+
+def get_systm_plan(url, token, start_date, end_date, window_days, max_workers):
+    """Get Wahoo SYSTM workouts for specified date range in windows and return them in plan order."""
+    windows = dict(iter_systm_workouts(url, token, start_date, end_date, window_days, max_workers))
+    return [item for window in sorted(windows) for item in windows[window]]
+
+
+@timed('detail')
 def get_systm_workout(url, token, workout_id):
     """Get Wahoo SYSTM details for specific workout and return response."""
     payload = json.dumps({
@@ -136,7 +479,7 @@ def get_systm_workout(url, token, workout_id):
         "variables": {
             "id": workout_id
         },
-        "query": "query GetWorkouts($id: ID) {workouts(id: $id) { id sortOrder sport stampImage bannerImage bestFor equipment { name description thumbnail __typename } details shortDescription level durationSeconds name triggers featuredRaces { name thumbnail darkBackgroundThumbnail __typename } metrics { intensityFactor tss ratings { nm ac map ftp __typename } __typename } brand nonAppWorkout notes tags imperatives { userSettings { birthday gender weight __typename } __typename } __typename}}"
+        "query": SYSTM_QUERIES[SYSTM_SETTINGS['query_profile']]['GetWorkouts']
     })
 
     headers = {
@@ -144,9 +487,143 @@ def get_systm_workout(url, token, workout_id):
         'Content-Type': 'application/json'
     }
 
-    response = call_api(url, "POST", headers, payload).text
+    response = call_api(url, "POST", headers, payload, operation='GetWorkouts').text
     return response
 
+
+def get_systm_workout_details(url, token, workout_ids, max_workers):
+    """Get Wahoo SYSTM details for multiple workouts concurrently and return them by workout id."""
+    # Remove duplicates while keeping the order of the plan, a workout can be scheduled more than once.
+    workout_ids = list(dict.fromkeys(workout_ids))
+
+    athlete = log_athlete.get()
+
+    def fetch(workout_id):
+        log_athlete.set(athlete)
+        start = time.perf_counter()
+        try:
+            detail = get_systm_workout(url, token, workout_id)
+        except Exception as err:
+            log(f'Error fetching workout {workout_id}: {err}')
+            detail = None
+        return detail, time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        results = list(executor.map(fetch, workout_ids))
+
+    # Report timings in plan order so the output is the same regardless of which request finished first.
+    details = {}
+    for workout_id, (detail, elapsed) in zip(workout_ids, results):
+        log(f'Fetched workout {workout_id} in {elapsed:.2f}s')
+        details[workout_id] = detail
+    if workout_ids:
+        log(f'Fetched {len(workout_ids)} workouts in {time.perf_counter() - start:.2f}s using {max(1, max_workers)} workers')
+    return details
+
+
+def get_cache_files(cache_dir, workout_id):
+    """Return cached files for workout id, newest first."""
+    prefix = f'{workout_id}-'
+    try:
+        names = [name for name in os.listdir(cache_dir) if name.startswith(prefix) and name.endswith('.json.gz')]
+        files = [os.path.join(cache_dir, name) for name in names]
+        return sorted(files, key=os.path.getmtime, reverse=True)
+    except OSError:
+        # Missing or unreadable cache, workouts are fetched from Wahoo SYSTM instead.
+        return []
+
+
+def get_cached_workouts(cache_dir, workout_ids, ttl_days):
+    """Return cached Wahoo SYSTM workout details by workout id, skipping entries older than ttl_days."""
+    cached = {}
+    max_age = ttl_days * 86400
+    now = time.time()
+    for workout_id in dict.fromkeys(workout_ids):
+        for filename in get_cache_files(cache_dir, workout_id):
+            try:
+                if max_age and now - os.path.getmtime(filename) > max_age:
+                    continue
+                with gzip.open(filename, 'rt', encoding='utf-8') as f:
+                    detail = f.read()
+            except (OSError, EOFError):
+                continue
+            # File name contains the hash of its contents, ignore files that were changed or got corrupted.
+            if filename.endswith(f'-{hashlib.sha256(detail.encode()).hexdigest()[:16]}.json.gz'):
+                cached[workout_id] = detail
+                break
+    with api_stats_lock:
+        cache_stats['hits'] += len(cached)
+        cache_stats['misses'] += len(set(workout_ids)) - len(cached)
+    return cached
+
+
+def store_cached_workout(cache_dir, workout_id, detail):
+    """Store Wahoo SYSTM workout details in the cache, keyed by workout id and hash of the contents. Errors are logged and ignored."""
+    # Only cache complete responses, errors should be fetched again on the next run.
+    try:
+        if not json_loads(detail)['data']['workouts']:
+            return
+    except (ValueError, KeyError, TypeError):
+        return
+    digest = hashlib.sha256(detail.encode()).hexdigest()[:16]
+    filename = os.path.join(cache_dir, f'{workout_id}-{digest}.json.gz')
+    # Write to a temporary file first, so athletes synced in parallel never read a partially written file.
+    temp_filename = f'{filename}.{os.getpid()}.{get_ident()}.tmp'
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        for old_file in get_cache_files(cache_dir, workout_id):
+            if old_file != filename:
+                try:
+                    os.remove(old_file)
+                except FileNotFoundError:
+                    pass
+        if os.path.exists(filename):
+            # Same contents, only refresh the timestamp used for the TTL.
+            os.utime(filename)
+            return
+        with gzip.open(temp_filename, 'wt', encoding='utf-8') as f:
+            f.write(detail)
+        os.replace(temp_filename, filename)
+    except OSError as err:
+        log(f'Could not cache workout {workout_id}: {err}')
+        try:
+            os.remove(temp_filename)
+        except OSError:
+            pass
+
+
+def prune_workout_cache(cache_dir, max_size):
+    """Remove oldest cached workouts until the cache is smaller than max_size bytes, errors are logged and ignored."""
+    if not max_size or not os.path.isdir(cache_dir):
+        return
+    try:
+        files = [os.path.join(cache_dir, name) for name in os.listdir(cache_dir) if name.endswith('.json.gz')]
+        files.sort(key=os.path.getmtime)
+        size = sum(os.path.getsize(filename) for filename in files)
+    except FileNotFoundError:
+        # Another athlete is pruning the cache at the same time.
+        return
+    except OSError as err:
+        log(f'Could not prune the workout cache: {err}')
+        return
+    while files and size > max_size:
+        filename = files.pop(0)
+        try:
+            size -= os.path.getsize(filename)
+            os.remove(filename)
+        except FileNotFoundError:
+            pass
+        except OSError as err:
+            log(f'Could not prune the workout cache: {err}')
+            return
+
+
+def get_intervals_icu_url(userid, path):
+    """Return intervals.icu API url for path of an athlete."""
+    return f"{INTERVALS_ICU_SETTINGS['url']}/athlete/{userid}/{path}"
+
+
 def get_intervals_icu_headers(api_key):
     """Return headers with token for Wahoo SYSTM API."""
     token = b64encode(f'API_KEY:{api_key}'.encode()).decode()
@@ -159,24 +636,92 @@ def get_intervals_icu_headers(api_key):
 
 def delete_intervals_icu_event(event_id, userid, api_key):
     """Delete specific intervals.icu event and return response."""
-    url = f'https://intervals.icu/api/v1/athlete/{userid}/events/{event_id}'
+    url = get_intervals_icu_url(userid, f'events/{event_id}')
     headers = get_intervals_icu_headers(api_key)
-    response = call_api(url, "DELETE", headers)
+    response = call_api(url, "DELETE", headers, operation='DeleteEvent')
     return response
 
 
+def delete_intervals_icu_events(event_ids, userid, api_key):
+    """Delete multiple intervals.icu events in one request and return response."""
+    url = get_intervals_icu_url(userid, 'events/bulk-delete')
+    headers = get_intervals_icu_headers(api_key)
+    payload = json.dumps([{"id": event_id} for event_id in event_ids])
+    response = call_api(url, "PUT", headers, payload, operation='BulkDeleteEvents')
+    return response
+
+
+@timed('delete')
+def remove_intervals_icu_events(event_ids, userid, api_key, chunk_size, max_workers):
+    """Delete intervals.icu events in bulk, fall back to single deletes. Return ids of deleted events."""
+    event_ids = list(dict.fromkeys(event_ids))
+    deleted = set()
+    remaining = []
+    chunk_size = max(1, chunk_size)
+    for start in range(0, len(event_ids), chunk_size):
+        chunk = event_ids[start:start + chunk_size]
+        try:
+            delete_intervals_icu_events(chunk, userid, api_key)
+            deleted.update(chunk)
+        except Exception as err:
+            log(f'Bulk delete of {len(chunk)} events failed, deleting them one by one: {err}')
+            remaining.extend(chunk)
+
+    if not remaining:
+        return deleted
+
+    # Single deletes are spaced out by the rate limiter of call_api().
+    athlete = log_athlete.get()
+
+    def delete(event_id):
+        log_athlete.set(athlete)
+        try:
+            delete_intervals_icu_event(event_id, userid, api_key)
+            return event_id
+        except Exception as err:
+            log(f'Error deleting event {event_id}: {err}')
+            return None
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        deleted.update(event_id for event_id in executor.map(delete, remaining) if event_id is not None)
+    return deleted
+
+
+def normalize_event_name(name):
+    """Return event name without characters that are removed from workout names, used to match existing events."""
+    return re.sub("[:?]", "", name or '')
+
+
+def index_intervals_icu_events(events):
+    """Return intervals.icu events by id and by (date, normalized name)."""
+    events_by_id = {}
+    events_by_key = {}
+    for event in events:
+        events_by_id[str(event['id'])] = event
+        events_by_key.setdefault((event['start_date_local'], normalize_event_name(event['name'])), []).append(event)
+    return events_by_id, events_by_key
+
+
+def find_intervals_icu_events(events_by_id, events_by_key, date, name, event_id=None):
+    """Return existing intervals.icu events with the same date and name, or with the given event id."""
+    matches = list(events_by_key.get((date, normalize_event_name(name)), []))
+    event = events_by_id.get(event_id)
+    if event is not None and event not in matches:
+        matches.append(event)
+    return matches
+
+
+@timed('events')
 def get_intervals_icu_events(oldest, newest, userid, api_key):
     """Get intervals.icu events for specified date range and return response."""
-    url = f'https://intervals.icu/api/v1/athlete/{userid}/events?oldest={oldest}&newest={newest}'
+    url = get_intervals_icu_url(userid, f'events?oldest={oldest}&newest={newest}')
     headers = get_intervals_icu_headers(api_key)
-    response = call_api(url, "GET", headers)
+    response = call_api(url, "GET", headers, operation='GetEvents')
     return response
 
 
-def upload_to_intervals_icu(date, name, sport, userid, api_key, contents=None, moving_time=None, description=None):
-    """Upload workout to intervals.icu and return response."""
-    url = f'https://intervals.icu/api/v1/athlete/{userid}/events'
-
+def get_intervals_icu_payload(date, name, sport, contents=None, moving_time=None, description=None, external_id=None):
+    """Return intervals.icu event for workout."""
     # Set defaults
     color = None
     category = 'WORKOUT'
@@ -186,17 +731,17 @@ def upload_to_intervals_icu(date, name, sport, userid, api_key, contents=None, m
         category = 'NOTE'
 
     if sport == 'VirtualRide':
-        payload = json.dumps({
+        payload = {
             "color": color,
             "category": category,
             "start_date_local": date,
             "type": sport,
             "filename": name,
             "file_contents": contents
-        })
+        }
 
     else:
-        payload = json.dumps({
+        payload = {
             "color": color,
             "start_date_local": date,
             "description": description,
@@ -204,35 +749,498 @@ def upload_to_intervals_icu(date, name, sport, userid, api_key, contents=None, m
             "name": name,
             "type": sport,
             "moving_time": moving_time
-        })
+        }
+
+    # External id is used by the bulk endpoint to update events uploaded earlier instead of creating duplicates.
+    if external_id:
+        payload['external_id'] = external_id
+
+    return payload
+
 
+def post_intervals_icu_event(payload, userid, api_key):
+    """Create single intervals.icu event and return response."""
+    url = get_intervals_icu_url(userid, 'events')
     headers = get_intervals_icu_headers(api_key)
-    response = call_api(url, "POST", headers, payload)
+    # Creating an event twice gives a duplicate, so don't retry it on server errors.
+    response = call_api(url, "POST", headers, json.dumps(payload), operation='CreateEvent', idempotent=False)
     return response
 
 
-def call_api(url, method, headers, payload=None):
-    """Call REST API and return response."""
-    try:
-        response = requests.request(method, url, headers=headers, data=payload)
-        response.raise_for_status()
-    except Exception as err:
-        raise(err)
+def put_intervals_icu_event(event_id, payload, userid, api_key):
+    """Update existing intervals.icu event and return response."""
+    url = get_intervals_icu_url(userid, f'events/{event_id}')
+    headers = get_intervals_icu_headers(api_key)
+    response = call_api(url, "PUT", headers, json.dumps(payload), operation='UpdateEvent')
     return response
 
 
+def post_intervals_icu_events(payloads, userid, api_key):
+    """Create or update multiple intervals.icu events by external id and return response."""
+    url = get_intervals_icu_url(userid, 'events/bulk?upsert=true')
+    headers = get_intervals_icu_headers(api_key)
+    response = call_api(url, "POST", headers, json.dumps(payloads), operation='BulkCreateEvents')
+    return response
+
+
+@timed('upload')
+def upload_events_to_intervals_icu(payloads, userid, api_key, chunk_size, existing=None):
+    """Upload events in chunks and return their intervals.icu event ids in the same order, None if the upload failed."""
+    # Event ids by external id, single uploads update these events instead of creating duplicates.
+    existing = existing or {}
+    event_ids = [None] * len(payloads)
+    chunk_size = max(1, chunk_size)
+    for start in range(0, len(payloads), chunk_size):
+        chunk = payloads[start:start + chunk_size]
+        created = {}
+        try:
+            response = post_intervals_icu_events(chunk, userid, api_key)
+            created = {event.get('external_id'): event.get('id') for event in response.json()}
+        except Exception as err:
+            log(f'Bulk upload of {len(chunk)} events failed, uploading them one by one: {err}')
+
+        # Events missing from the bulk response are uploaded one by one.
+        for index, payload in enumerate(chunk, start):
+            event_id = created.get(payload.get('external_id'))
+            if event_id is None:
+                try:
+                    if payload.get('external_id') in existing:
+                        event_id = put_intervals_icu_event(existing[payload['external_id']], payload, userid, api_key).json().get('id')
+                    else:
+                        event_id = post_intervals_icu_event(payload, userid, api_key).json().get('id')
+                except Exception as err:
+                    log(f"Error uploading event on {payload['start_date_local'][:10]}: {err}")
+            event_ids[index] = event_id
+    return event_ids
+
+
+def open_sync_state(filename):
+    """Open sync state database, create it if it doesn't exist."""
+    # Athletes synced in parallel share the database, wait for each other's writes instead of failing.
+    connection = sqlite3.connect(filename, timeout=30)
+    connection.execute("CREATE TABLE IF NOT EXISTS events (athlete_id TEXT, planned_date TEXT, workout_id TEXT, content_hash TEXT, event_id TEXT, PRIMARY KEY (athlete_id, planned_date, workout_id))")
+    connection.commit()
+    return connection
+
+
+def get_sync_state(connection, athlete_id):
+    """Return content hash and intervals.icu event id of uploaded workouts by (planned date, workout id)."""
+    rows = connection.execute("SELECT planned_date, workout_id, content_hash, event_id FROM events WHERE athlete_id = ?", (athlete_id,))
+    return {(planned_date, workout_id): (content_hash, event_id) for planned_date, workout_id, content_hash, event_id in rows}
+
+
+def update_sync_state(connection, athlete_id, planned_date, workout_id, content_hash, event_id):
+    """Store content hash and intervals.icu event id of an uploaded workout."""
+    connection.execute("INSERT OR REPLACE INTO events VALUES (?, ?, ?, ?, ?)", (athlete_id, planned_date, workout_id, content_hash, str(event_id)))
+    connection.commit()
+
+
+def remove_sync_state(connection, athlete_id, planned_date, workout_id):
+    """Remove uploaded workout from sync state."""
+    connection.execute("DELETE FROM events WHERE athlete_id = ? AND planned_date = ? AND workout_id = ?", (athlete_id, planned_date, workout_id))
+    connection.commit()
+
+
+def get_content_hash(payload):
+    """Return hash of intervals.icu event payload, used to detect changed workouts."""
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+
+def configure_intervals_icu(url='https://intervals.icu/api/v1'):
+    """Set base url used for intervals.icu API calls."""
+    INTERVALS_ICU_SETTINGS['url'] = url.rstrip('/')
+
+
+def configure_systm(query_profile='minimal'):
+    """Set GraphQL query profile used for Wahoo SYSTM API calls."""
+    if query_profile not in SYSTM_QUERIES:
+        raise ValueError(f"Unknown query profile {query_profile}, use one of {', '.join(SYSTM_QUERIES)}.")
+    SYSTM_SETTINGS['query_profile'] = query_profile
+
+
+def configure_http(pool_size=10, timeout=30.0, retries=3, backoff=0.5, rate_limit=10.0, burst=10):
+    """Set connection pool, timeout, retry and rate limit settings for all API calls."""
+    HTTP_SETTINGS.update({'pool_size': pool_size, 'timeout': timeout, 'retries': retries, 'backoff': backoff, 'rate_limit': rate_limit, 'burst': burst})
+    # Sessions and rate limiters created with the old settings are dropped, new ones get created on the next call.
+    with http_sessions_lock:
+        for session in http_sessions.values():
+            session.close()
+        http_sessions.clear()
+        rate_limiters.clear()
+
+
+def get_http_session(url):
+    """Return keep-alive session for the host in url, create it on first use."""
+    host = urlsplit(url).netloc
+    with http_sessions_lock:
+        session = http_sessions.get(host)
+        if session is None:
+            # Retry on connection errors, rate limiting and server errors are retried by call_api().
+            # Read errors are only retried for idempotent methods, a POST may have been processed already.
+            retry = Retry(
+                total=HTTP_SETTINGS['retries'],
+                backoff_factor=HTTP_SETTINGS['backoff'],
+                respect_retry_after_header=False,
+                raise_on_status=False
+            )
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_SETTINGS['pool_size'], max_retries=retry)
+            session = requests.Session()
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            http_sessions[host] = session
+    return session
+
+
+def get_rate_limiter(url):
+    """Return rate limiter for the host in url, create it on first use."""
+    host = urlsplit(url).netloc
+    with http_sessions_lock:
+        limiter = rate_limiters.get(host)
+        if limiter is None:
+            limiter = rate_limiters[host] = RateLimiter(HTTP_SETTINGS['rate_limit'], HTTP_SETTINGS['burst'])
+    return limiter
+
+
+def get_retry_delay(response, attempt):
+    """Return seconds to wait before retrying response, from its Retry-After header or exponential backoff."""
+    retry_after = response.headers.get('Retry-After')
+    if retry_after:
+        try:
+            delay = float(retry_after)
+        except ValueError:
+            try:
+                delay = (parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds()
+            except (TypeError, ValueError):
+                delay = None
+        if delay is not None:
+            return min(max(delay, 0), MAX_RETRY_AFTER)
+    return HTTP_SETTINGS['backoff'] * 2 ** attempt
+
+
+def call_api(url, method, headers, payload=None, operation=None, idempotent=True):
+    """Call REST API using the pooled session and rate limiter for its host and return response.
+
+    Rate limited requests and server errors are retried, waiting as long as the Retry-After header asks for.
+    Requests that aren't idempotent are only retried when rate limited, a server error may come after the request was processed.
+    """
+    retry_status = RETRY_STATUS if idempotent else THROTTLE_STATUS
+    host = urlsplit(url).netloc
+    operation = operation or f'{method} {host}'
+    session = get_http_session(url)
+    limiter = get_rate_limiter(url)
+    for attempt in range(HTTP_SETTINGS['retries'] + 1):
+        waited = limiter.acquire()
+        start = time.perf_counter()
+        size = 0
+        try:
+            response = session.request(method, url, headers=headers, data=payload, timeout=HTTP_SETTINGS['timeout'])
+            size = len(response.content)
+        finally:
+            record_api_call(operation, size, time.perf_counter() - start, waited=waited, retried=attempt > 0, host=host)
+        if response.status_code not in retry_status or attempt == HTTP_SETTINGS['retries']:
+            break
+        delay = get_retry_delay(response, attempt)
+        if response.status_code in THROTTLE_STATUS:
+            # Slow down all requests to this host, not just this one.
+            record_api_call(operation, throttled=True, host=host)
+            limiter.throttle(delay)
+        else:
+            time.sleep(delay)
+    if response.status_code < 400:
+        limiter.recover()
+    response.raise_for_status()
+    return response
+
+
+def record_api_call(operation, size=0, elapsed=0.0, waited=0.0, retried=False, throttled=False, host=None):
+    """Add API call to the statistics of its operation, a throttled response is added without counting a request."""
+    with api_stats_lock:
+        stats = api_stats.setdefault(operation, {'host': host, 'requests': 0, 'bytes': 0, 'seconds': 0.0, 'waited': 0.0, 'retried': 0, 'throttled': 0})
+        if throttled:
+            stats['throttled'] += 1
+            return
+        stats['requests'] += 1
+        stats['bytes'] += size
+        stats['seconds'] += elapsed
+        stats['waited'] += waited
+        stats['retried'] += retried
+
+
+def print_api_stats():
+    """Print number of requests, bytes received, time spent, throttled and retried requests per API operation."""
+    with api_stats_lock:
+        stats = sorted(api_stats.items())
+    for operation, item in stats:
+        average = item['seconds'] / item['requests'] * 1000
+        line = f"{operation}: {item['requests']} requests, {item['bytes'] / 1024:.1f} KiB, {item['seconds']:.2f}s ({average:.0f} ms/request)"
+        if item['throttled'] or item['retried']:
+            line += f", {item['throttled']} throttled, {item['retried']} retried"
+        if item['waited'] >= 0.01:
+            line += f", {item['waited']:.2f}s waiting for rate limit"
+        print(line)
+
+
+def print_stage_stats():
+    """Print number of calls and time spent per stage of the sync and the workout cache hit rate."""
+    with api_stats_lock:
+        stats = sorted(stage_stats.items())
+        hits, misses = cache_stats['hits'], cache_stats['misses']
+    for (athlete, stage), item in stats:
+        prefix = f'[{athlete}] ' if athlete else ''
+        print(f"{prefix}Stage {stage}: {item['calls']} calls, {item['seconds']:.2f}s (slowest {item['max_seconds']:.2f}s)")
+    if hits or misses:
+        print(f'Workout cache: {hits} hits, {misses} misses ({hits / (hits + misses):.0%} hit rate)')
+
+
+def reset_stats():
+    """Clear API, stage and cache statistics."""
+    with api_stats_lock:
+        api_stats.clear()
+        stage_stats.clear()
+        cache_stats.update({'hits': 0, 'misses': 0})
+
+
+def get_metrics(duration, success):
+    """Return API, stage and cache statistics of a sync as a list of metric records."""
+    timestamp = datetime.now(timezone.utc).isoformat(timespec='seconds')
+    with api_stats_lock:
+        metrics = [{'type': 'run', 'time': timestamp, 'seconds': round(duration, 3), 'success': success}]
+        for (athlete, stage), item in sorted(stage_stats.items()):
+            metrics.append({'type': 'stage', 'time': timestamp, 'athlete': athlete, 'stage': stage, 'calls': item['calls'], 'seconds': round(item['seconds'], 3), 'max_seconds': round(item['max_seconds'], 3)})
+        for operation, item in sorted(api_stats.items()):
+            metrics.append({'type': 'api', 'time': timestamp, 'host': item['host'], 'operation': operation, 'requests': item['requests'], 'bytes': item['bytes'], 'seconds': round(item['seconds'], 3), 'retried': item['retried'], 'throttled': item['throttled']})
+        hits, misses = cache_stats['hits'], cache_stats['misses']
+        metrics.append({'type': 'cache', 'time': timestamp, 'hits': hits, 'misses': misses, 'hit_rate': round(hits / (hits + misses), 3) if hits or misses else None})
+    return metrics
+
+
+def format_prometheus_metrics(metrics):
+    """Return metric records in Prometheus text format, for the node_exporter textfile collector."""
+    def labels(**values):
+        escaped = {key: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for key, value in values.items()}
+        return '{' + ','.join(f'{key}="{value}"' for key, value in escaped.items()) + '}'
+
+    series = {
+        'suffersync_last_run_timestamp_seconds': ('Time of the last sync.', []),
+        'suffersync_last_run_duration_seconds': ('Duration of the last sync.', []),
+        'suffersync_last_run_success': ('1 if the last sync succeeded.', []),
+        'suffersync_stage_calls': ('Calls per stage of the last sync.', []),
+        'suffersync_stage_seconds': ('Seconds spent per stage of the last sync, summed over parallel calls.', []),
+        'suffersync_stage_max_seconds': ('Slowest call per stage of the last sync.', []),
+        'suffersync_api_requests': ('API requests of the last sync, including retries.', []),
+        'suffersync_api_response_bytes': ('Bytes received from the API in the last sync.', []),
+        'suffersync_api_seconds': ('Seconds spent on API requests in the last sync.', []),
+        'suffersync_api_retried_requests': ('Retried API requests in the last sync.', []),
+        'suffersync_api_throttled_requests': ('API requests throttled by the host in the last sync.', []),
+        'suffersync_cache_hits': ('Workouts loaded from the cache in the last sync.', []),
+        'suffersync_cache_misses': ('Workouts not found in the cache in the last sync.', []),
+    }
+    for metric in metrics:
+        if metric['type'] == 'run':
+            series['suffersync_last_run_timestamp_seconds'][1].append(('', f'{time.time():.0f}'))
+            series['suffersync_last_run_duration_seconds'][1].append(('', metric['seconds']))
+            series['suffersync_last_run_success'][1].append(('', int(metric['success'])))
+        elif metric['type'] == 'stage':
+            label = labels(athlete=metric['athlete'], stage=metric['stage'])
+            series['suffersync_stage_calls'][1].append((label, metric['calls']))
+            series['suffersync_stage_seconds'][1].append((label, metric['seconds']))
+            series['suffersync_stage_max_seconds'][1].append((label, metric['max_seconds']))
+        elif metric['type'] == 'api':
+            label = labels(host=metric['host'], operation=metric['operation'])
+            series['suffersync_api_requests'][1].append((label, metric['requests']))
+            series['suffersync_api_response_bytes'][1].append((label, metric['bytes']))
+            series['suffersync_api_seconds'][1].append((label, metric['seconds']))
+            series['suffersync_api_retried_requests'][1].append((label, metric['retried']))
+            series['suffersync_api_throttled_requests'][1].append((label, metric['throttled']))
+        elif metric['type'] == 'cache':
+            series['suffersync_cache_hits'][1].append(('', metric['hits']))
+            series['suffersync_cache_misses'][1].append(('', metric['misses']))
+    lines = []
+    for name, (help_text, samples) in series.items():
+        if samples:
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} gauge')
+            lines.extend(f'{name}{label} {value}' for label, value in samples)
+    return '\n'.join(lines) + '\n'
+
+
+def write_metrics(filename, metrics_format, duration, success):
+    """Append metrics of a sync to filename as JSON lines, or replace filename with a Prometheus textfile."""
+    metrics = get_metrics(duration, success)
+    if metrics_format == 'prometheus':
+        # Write to a temporary file first, so the textfile collector never reads a partial file.
+        tmp_filename = f'{filename}.{os.getpid()}.tmp'
+        with open(tmp_filename, 'w', encoding='utf-8') as f:
+            f.write(format_prometheus_metrics(metrics))
+        os.replace(tmp_filename, filename)
+    else:
+        with open(filename, 'a', encoding='utf-8') as f:
+            for metric in metrics:
+                f.write(json.dumps(metric) + '\n')
+
+
+# Schema of the 'triggers' of a Wahoo SYSTM workout: triggers contain tracks, tracks contain workout steps.
+if msgspec is not None:
+    class Target(msgspec.Struct):
+        value: Any = None
+
+    class Step(msgspec.Struct):
+        size: Any = 0
+        parameters: Dict[str, Target] = {}
+
+    class Track(msgspec.Struct):
+        objects: List[Step] = []
+
+    class Trigger(msgspec.Struct):
+        tracks: List[Track] = []
+
+    triggers_decoder = msgspec.json.Decoder(List[Trigger])
+else:
+    class Target:
+        __slots__ = ('value',)
+
+        def __init__(self, value=None):
+            self.value = value
+
+    class Step:
+        __slots__ = ('size', 'parameters')
+
+        def __init__(self, size=0, parameters=None):
+            self.size = size
+            self.parameters = parameters or {}
+
+    class Track:
+        __slots__ = ('objects',)
+
+        def __init__(self, objects=None):
+            self.objects = objects or []
+
+    class Trigger:
+        __slots__ = ('tracks',)
+
+        def __init__(self, tracks=None):
+            self.tracks = tracks or []
+
+    triggers_decoder = None
+
+
+def decode_triggers(triggers):
+    """Return Wahoo SYSTM workout triggers JSON string as list of Trigger objects."""
+    if not triggers:
+        return []
+    if triggers_decoder is not None:
+        return triggers_decoder.decode(triggers)
+    return [
+        Trigger([
+            Track([
+                Step(item.get('size', 0), {name: Target(parameter.get('value')) for name, parameter in item.get('parameters', {}).items()})
+                for item in track.get('objects', [])
+            ])
+            for track in trigger.get('tracks', [])
+        ])
+        for trigger in json_loads(triggers)
+    ]
+
+
 def clean_workout(workout):
-    """Return workout with interval details as JSON string."""
-    workout_json = json.loads(workout)
-    workout_json['data']['workouts'][0]['triggers'] = json.loads(workout_json['data']['workouts'][0]['triggers'])
+    """Return workout with interval details decoded into Trigger objects."""
+    workout_json = json_loads(workout)
+    workout_json['data']['workouts'][0]['triggers'] = decode_triggers(workout_json['data']['workouts'][0]['triggers'])
     return workout_json
 
 
+def get_power_scales(profile):
+    """Return factors that convert Wahoo SYSTM 4DP targets into fractions of FTP for a rider profile."""
+    ftp = profile['ftp']
+    return {
+        'ftp': ftp,
+        'twentyMin': 1,
+        'map': round(profile['map'] / ftp, 2),
+        'ac': round(profile['ac'] / ftp, 2),
+        'nm': round(profile['nm'] / ftp, 2)
+    }
+
+
+def get_workout_steps(triggers):
+    """Flatten workout triggers into columns with the duration and targets of every step, None if a target isn't set."""
+    objects = [item for interval in triggers for track in interval.tracks for item in track.objects]
+    steps = {'duration': [int(item.size / 1000) for item in objects]}
+    for target in ('ftp', 'twentyMin', 'map', 'ac', 'nm', 'rpm'):
+        steps[target] = [item.parameters[target].value if target in item.parameters else None for item in objects]
+    return steps
+
+
+def get_power_targets(steps, scales):
+    """Return power as fraction of FTP and absolute power for every workout step."""
+    power = steps['ftp']
+    # Targets further down the list take precedence, 'twentyMin' always seems to be the same as 'ftp' in my data.
+    for target in ('twentyMin', 'map', 'ac', 'nm'):
+        scale = scales[target]
+        power = [current if value is None else value * scale for value, current in zip(steps[target], power)]
+    absolute_power = [round(value * scales['ftp']) if value else None for value in power]
+    return power, absolute_power
+
+
+def generate_zwo(name, description, sporttype, triggers, scales):
+    """Yield .zwo workout file for Wahoo SYSTM workout triggers in parts."""
+    yield f"""<workout_file>
+    <author></author>
+    <name>{name}</name>
+    <description>{description}</description>
+    <sportType>{sporttype}</sportType>
+    <tags></tags>
+    <workout>"""
+
+    steps = get_workout_steps(triggers)
+    power, absolute_power = get_power_targets(steps, scales)
+    for seconds, step_power, step_absolute_power, rpm in zip(steps['duration'], power, absolute_power, steps['rpm']):
+        if not step_power:
+            continue
+        if rpm is not None:
+            yield f'\n\t\t<SteadyState show_avg="1" Cadence="{rpm}" Power="{step_power}" Duration="{seconds}"/><!-- abs power: {step_absolute_power} -->'
+        else:
+            yield f'\n\t\t<SteadyState show_avg="1" Power="{step_power}" Duration="{seconds}"/><!-- abs power: {step_absolute_power} -->'
+
+    yield r"""
+    </workout>
+</workout_file>"""
+
+
+@timed('render')
+def build_zwo(name, description, sporttype, triggers, scales):
+    """Return .zwo workout file for Wahoo SYSTM workout triggers as string."""
+    return ''.join(generate_zwo(name, description, sporttype, triggers, scales))
+
+
+def read_athlete(config, section, intervals_section):
+    """Return Wahoo SYSTM and intervals.icu settings of an athlete from the config file."""
+    athlete = {
+        'name': section[len('ATHLETE'):].strip() if section != 'WAHOO' else None,
+        'SYSTM_USERNAME': config.get(section, 'SYSTM_USERNAME'),
+        'SYSTM_PASSWORD': config.get(section, 'SYSTM_PASSWORD'),
+        'START_DATE': config.get(section, 'START_DATE'),
+        'END_DATE': config.get(section, 'END_DATE'),
+        'INTERVALS_ICU_ID': config.get(intervals_section, 'INTERVALS_ICU_ID'),
+        'INTERVALS_ICU_APIKEY': config.get(intervals_section, 'INTERVALS_ICU_APIKEY')
+    }
+    # Upload settings can be changed per athlete, otherwise the value in [DEFAULT] is used.
+    for key in ('UPLOAD_PAST_WORKOUTS', 'UPLOAD_STRENGTH_WORKOUTS', 'UPLOAD_YOGA_WORKOUTS', 'UPLOAD_RUN_WORKOUTS', 'UPLOAD_SWIM_WORKOUTS', 'UPLOAD_DESCRIPTION'):
+        athlete[key] = config.getint(section, key, fallback=0)
+    return athlete
+
+
+def read_athletes(config):
+    """Return settings of all athletes in the config file, one per [ATHLETE <name>] section or the [WAHOO] and [INTERVALS.ICU] sections."""
+    sections = [section for section in config.sections() if section.upper().startswith('ATHLETE ')]
+    if sections:
+        return [read_athlete(config, section, section) for section in sections]
+    return [read_athlete(config, 'WAHOO', 'INTERVALS.ICU')]
+
+
 def main():
     """Main function"""
     # Read config file, create it if it doesn't exist
     CONFIGFILE = 'suffersync.cfg'
-    SYSTM_URL = "https://api.thesufferfest.com/graphql"
 
     config = configparser.ConfigParser(interpolation=None)
 
@@ -240,19 +1248,28 @@ def main():
     if config_exists:
         try:
             config.read(CONFIGFILE)
-            UPLOAD_PAST_WORKOUTS = config.getint('DEFAULT', 'UPLOAD_PAST_WORKOUTS', fallback=0)
-            UPLOAD_STRENGTH_WORKOUTS = config.getint('DEFAULT', 'UPLOAD_STRENGTH_WORKOUTS', fallback=0)
-            UPLOAD_YOGA_WORKOUTS = config.getint('DEFAULT', 'UPLOAD_YOGA_WORKOUTS', fallback=0)
-            UPLOAD_RUN_WORKOUTS = config.getint('DEFAULT', 'UPLOAD_RUN_WORKOUTS', fallback=0)
-            UPLOAD_SWIM_WORKOUTS = config.getint('DEFAULT', 'UPLOAD_SWIM_WORKOUTS', fallback=0)
-            UPLOAD_DESCRIPTION = config.getint('DEFAULT', 'UPLOAD_DESCRIPTION', fallback=0)
-            SYSTM_USERNAME = config.get('WAHOO', 'SYSTM_USERNAME')
-            SYSTM_PASSWORD = config.get('WAHOO', 'SYSTM_PASSWORD')
-            START_DATE = config.get('WAHOO', 'START_DATE')
-            END_DATE = config.get('WAHOO', 'END_DATE')
-            INTERVALS_ICU_ID = config.get('INTERVALS.ICU', 'INTERVALS_ICU_ID')
-            INTERVALS_ICU_APIKEY = config.get('INTERVALS.ICU', 'INTERVALS_ICU_APIKEY')
-        except KeyError as err:
+            BULK_UPLOAD_SIZE = config.getint('DEFAULT', 'BULK_UPLOAD_SIZE', fallback=50)
+            MAX_CONCURRENT_REQUESTS = config.getint('DEFAULT', 'MAX_CONCURRENT_REQUESTS', fallback=4)
+            PLAN_WINDOW_DAYS = config.getint('DEFAULT', 'PLAN_WINDOW_DAYS', fallback=31)
+            MAX_CONCURRENT_ATHLETES = config.getint('DEFAULT', 'MAX_CONCURRENT_ATHLETES', fallback=2)
+            QUERY_PROFILE = config.get('DEFAULT', 'QUERY_PROFILE', fallback='minimal')
+            HTTP_POOL_SIZE = config.getint('DEFAULT', 'HTTP_POOL_SIZE', fallback=10)
+            HTTP_TIMEOUT = config.getfloat('DEFAULT', 'HTTP_TIMEOUT', fallback=30.0)
+            HTTP_RETRIES = config.getint('DEFAULT', 'HTTP_RETRIES', fallback=3)
+            HTTP_BACKOFF = config.getfloat('DEFAULT', 'HTTP_BACKOFF', fallback=0.5)
+            HTTP_RATE_LIMIT = config.getfloat('DEFAULT', 'HTTP_RATE_LIMIT', fallback=10)
+            HTTP_RATE_BURST = config.getint('DEFAULT', 'HTTP_RATE_BURST', fallback=10)
+            CACHE_DIR = config.get('DEFAULT', 'CACHE_DIR', fallback='cache')
+            CACHE_TTL_DAYS = config.getfloat('DEFAULT', 'CACHE_TTL_DAYS', fallback=30)
+            CACHE_MAX_SIZE_MB = config.getfloat('DEFAULT', 'CACHE_MAX_SIZE_MB', fallback=50)
+            STATE_FILE = config.get('DEFAULT', 'STATE_FILE', fallback='suffersync.db')
+            TOKEN_FILE = config.get('DEFAULT', 'TOKEN_FILE', fallback='suffersync.token')
+            TOKEN_TTL_HOURS = config.getfloat('DEFAULT', 'TOKEN_TTL_HOURS', fallback=24)
+            ZWO_DIR = config.get('DEFAULT', 'ZWO_DIR', fallback='zwo')
+            SYSTM_URL = config.get('DEFAULT', 'SYSTM_URL', fallback='https://api.thesufferfest.com/graphql')
+            INTERVALS_ICU_URL = config.get('DEFAULT', 'INTERVALS_ICU_URL', fallback='https://intervals.icu/api/v1')
+            athletes = read_athletes(config)
+        except (KeyError, configparser.Error) as err:
             print(f'No valid value found for key {err} in {CONFIGFILE}.')
             sys.exit(1)
     else:
@@ -261,198 +1278,625 @@ def main():
     # Check CLI arguments
     parser = argparse.ArgumentParser()
     parser.add_argument('-d', '--delete', help='Delete all events for the specified date range in intervals.icu.', action='store_true')
+    parser.add_argument('--category', help='Only delete events of these comma separated categories, e.g. WORKOUT,NOTE.')
+    parser.add_argument('--name', help='Only delete events with a name matching this regular expression.')
+    parser.add_argument('--start-date', help='Use this start date (YYYY-MM-DD) instead of START_DATE in the config file.')
+    parser.add_argument('--end-date', help='Use this end date (YYYY-MM-DD) instead of END_DATE in the config file.')
+    parser.add_argument('-n', '--dry-run', help='Show which events would be created, updated or deleted without changing anything in intervals.icu, implies --no-files.', action='store_true')
+    parser.add_argument('--diff', help='Write the events a dry run would create, update or delete to this file as JSON lines, implies --dry-run.')
+    parser.add_argument('-r', '--refresh', help='Ignore cached workout details and login token, download them again from Wahoo SYSTM.', action='store_true')
+    parser.add_argument('-f', '--force', help='Upload all workouts again, including the ones that did not change since the last sync.', action='store_true')
+    parser.add_argument('--no-files', help='Do not store the generated .zwo files.', action='store_true')
+    parser.add_argument('--out-dir', help='Store the generated .zwo files in this directory instead of ZWO_DIR in the config file.')
+    parser.add_argument('--async', dest='use_async', help='Fetch, render and upload workouts in overlapping stages instead of one after the other.', action='store_true')
+    parser.add_argument('--stats', help='Show number of requests, bytes received and time spent per API operation and stage of the sync.', action='store_true')
+    parser.add_argument('--metrics-file', help='Write timings, API requests and cache hit rate of the sync to this file.')
+    parser.add_argument('--metrics-format', help='Format of the metrics file: jsonl (appended, default) or prometheus (replaced, for the node_exporter textfile collector).', choices=('jsonl', 'prometheus'))
+    parser.add_argument('-a', '--athlete', help='Only sync these comma separated athletes from the [ATHLETE <name>] sections in the config file.')
     args = parser.parse_args()
+    if (args.category or args.name) and not args.delete:
+        parser.error('--category and --name can only be used with -d/--delete')
+    if args.name:
+        try:
+            re.compile(args.name)
+        except re.error as err:
+            print(f'Invalid regular expression for --name: {err}.')
+            sys.exit(1)
+    if args.diff:
+        args.dry_run = True
+        # Every athlete appends its changes, start with an empty file.
+        open(args.diff, 'w', encoding='utf-8').close()
+    if args.dry_run:
+        # A dry run doesn't change anything, including the .zwo files of the last sync.
+        args.no_files = True
+
+    if args.athlete:
+        names = {name.strip() for name in args.athlete.split(',')}
+        athletes = [athlete for athlete in athletes if athlete['name'] in names]
+        if not athletes:
+            print(f'No athletes named {args.athlete} found in {CONFIGFILE}.')
+            sys.exit(1)
 
-    # Get Wahoo SYSTM auth token
-    systm_token = get_systm_token(SYSTM_URL, SYSTM_USERNAME, SYSTM_PASSWORD)
+    settings = {
+        'SYSTM_URL': SYSTM_URL,
+        'BULK_UPLOAD_SIZE': BULK_UPLOAD_SIZE,
+        'MAX_CONCURRENT_REQUESTS': MAX_CONCURRENT_REQUESTS,
+        'PLAN_WINDOW_DAYS': PLAN_WINDOW_DAYS,
+        'CACHE_DIR': CACHE_DIR,
+        'CACHE_TTL_DAYS': CACHE_TTL_DAYS,
+        'CACHE_MAX_SIZE_MB': CACHE_MAX_SIZE_MB,
+        'STATE_FILE': STATE_FILE,
+        'TOKEN_FILE': TOKEN_FILE,
+        'TOKEN_TTL_HOURS': TOKEN_TTL_HOURS,
+        'ZWO_DIR': args.out_dir or ZWO_DIR
+    }
+
+    configure_intervals_icu(INTERVALS_ICU_URL)
+    configure_http(HTTP_POOL_SIZE, HTTP_TIMEOUT, HTTP_RETRIES, HTTP_BACKOFF, HTTP_RATE_LIMIT, HTTP_RATE_BURST)
+    try:
+        configure_systm(QUERY_PROFILE)
+    except ValueError as err:
+        print(f'{err} Check QUERY_PROFILE in {CONFIGFILE}.')
+        sys.exit(1)
 
-    # Get Wahoo SYSTM workouts from training plan
-    workouts = get_systm_workouts(SYSTM_URL, systm_token, START_DATE, END_DATE)
+    reset_stats()
+    start = time.perf_counter()
+    success = False
+    try:
+        if len(athletes) == 1:
+            sync_athlete(athletes[0], settings, args)
+        else:
+            sync_athletes(athletes, settings, args, MAX_CONCURRENT_ATHLETES)
+        success = True
+    except SystemExit as err:
+        success = not err.code
+        raise
+    finally:
+        if args.stats:
+            print_api_stats()
+            print_stage_stats()
+        if args.metrics_file:
+            metrics_format = args.metrics_format or ('prometheus' if args.metrics_file.endswith('.prom') else 'jsonl')
+            write_metrics(args.metrics_file, metrics_format, time.perf_counter() - start, success)
+
+
+def sync_athletes(athletes, settings, args, max_workers):
+    """Sync multiple athletes in parallel, a failing athlete doesn't stop the others."""
+    def run(athlete):
+        log_athlete.set(athlete['name'])
+        try:
+            sync_athlete(athlete, settings, args)
+            return True
+        except SystemExit as err:
+            return not err.code
+        except Exception as err:
+            log(f'Error: {err}')
+            return False
+        finally:
+            log_athlete.set(None)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        results = list(executor.map(run, athletes))
+    failed = [athlete['name'] for athlete, success in zip(athletes, results) if not success]
+    print(f'Synced {len(athletes) - len(failed)} of {len(athletes)} athletes in {time.perf_counter() - start:.2f}s.')
+    if failed:
+        print(f"Sync failed for {', '.join(failed)}.")
+        sys.exit(1)
 
-    # Only get the workout portion of the returned data
-    workouts = workouts['data']['userPlan']
 
-    # Retrieve all intervals.icu workouts for the date range
-    response = get_intervals_icu_events(START_DATE, END_DATE, INTERVALS_ICU_ID, INTERVALS_ICU_APIKEY)
-    response_json = response.json()
-    events = []
+def get_plan_key(item):
+    """Return (planned date, workout id) of a workout in the Wahoo SYSTM plan, used to track uploaded workouts."""
+    workout_date_datetime = datetime.strptime(item['plannedDate'], "%Y-%m-%dT%H:%M:%S.%fZ").date()
+    return str(workout_date_datetime), item['prospects'][0]['workoutId']
 
-    # Store existing intervals.icu events, delete if -d CLI argument was provided
+
+def get_intervals_icu_event_list(response_json):
+    """Return date, name, id, category and external id of intervals.icu events."""
+    events = []
     for item in response_json:
         start_date_local = item['start_date_local']
         start_date_local = datetime.strptime(start_date_local, "%Y-%m-%dT%H:%M:%S").date()
         # Store intervals.icu event date, name & id in 'event' list
-        event = {"start_date_local": start_date_local, "name": item['name'], "id": item['id']}
+        event = {"start_date_local": start_date_local, "name": item['name'], "id": item['id'], "category": item.get('category'), "external_id": item.get('external_id')}
         events.append(event)
+    return events
 
-        # If -d/--delete CLI argument was provided, delete the workout.
-        if args.delete:
-            print(f"Deleting workout {event['name']} on {event['start_date_local']}")
-            delete_intervals_icu_event(event['id'], INTERVALS_ICU_ID, INTERVALS_ICU_APIKEY)
 
-    if args.delete:
-        print('All workouts removed, start suffersync again without any arguments.')
-        sys.exit(0)
+def get_workout_upload(payload, state_key, workout_date, workout_name, sport, args, sync_state, events_by_id, events_by_key, deletions):
+    """Return upload for the intervals.icu payload of a workout, None if it didn't change. Events it replaces are added to deletions."""
+    content_hash = get_content_hash(payload)
+    previous_hash, previous_event_id = sync_state.get(state_key, (None, None))
+    if not args.force and previous_hash == content_hash and previous_event_id in events_by_id:
+        log(f'Unchanged {workout_date}: {workout_name} ({sport}), skipping.')
+        return None
+    for event in find_intervals_icu_events(events_by_id, events_by_key, workout_date, workout_name, previous_event_id):
+        # Events with the same external id are updated by the upload, no need to remove them.
+        if event['external_id'] != payload.get('external_id'):
+            deletions[event['id']] = f"{workout_date}: {event['name']} (id {event['id']})"
+    return {"state_key": state_key, "payload": payload, "content_hash": content_hash, "label": f'{workout_date}: {workout_name} ({sport})'}
 
+
+def prepare_workout(item, workout_detail, athlete, args, zwo_dir, power_scales, sync_state, events_by_id, events_by_key, deletions):
+    """Return upload for a workout in the plan, None if it's skipped or didn't change. Events it replaces are added to deletions."""
     today = datetime.today().date()
 
-    # For each workout, make sure there's a "plannedDate" field to avoid bogus entries.
-    for item in workouts:
-        if item['plannedDate']:
-            # Get plannedDate, convert to datetime & formatted string for further use
-            planned_date = item['plannedDate']
-            workout_date_datetime = datetime.strptime(planned_date, "%Y-%m-%dT%H:%M:%S.%fZ").date()
-            workout_date_string = workout_date_datetime.strftime('%Y-%m-%dT%H:%M:%S')
+    # Get plannedDate, convert to datetime & formatted string for further use
+    planned_date = item['plannedDate']
+    workout_date_datetime = datetime.strptime(planned_date, "%Y-%m-%dT%H:%M:%S.%fZ").date()
+    workout_date_string = workout_date_datetime.strftime('%Y-%m-%dT%H:%M:%S')
 
-            # Get workout name and remove invalid characters to avoid filename issues.
-            workout_name = item['prospects'][0]['name']
-            workout_name_remove_invalid_chars = re.sub("[:?]", "", workout_name)
-            workout_name_underscores = re.sub("[ ,./]", "_", workout_name_remove_invalid_chars)
-            filename = f'{workout_date_datetime}_{workout_name_underscores}'
+    # Get workout name and remove invalid characters to avoid filename issues.
+    workout_name = item['prospects'][0]['name']
+    workout_name_remove_invalid_chars = normalize_event_name(workout_name)
+    workout_name_underscores = re.sub("[ ,./]", "_", workout_name_remove_invalid_chars)
+    filename = f'{workout_date_datetime}_{workout_name_underscores}'
 
-            try:
-                workout_id = item['prospects'][0]['workoutId']
-                workout_type = item['prospects'][0]['type']
+    workout_id = item['prospects'][0]['workoutId']
+    state_key = get_plan_key(item)
+    external_id = f'suffersync-{workout_date_datetime}-{workout_id}'
 
-                # get_intervals_sport will get the intervals.icu name for SYSTM's equivalent sport
-                sport = get_intervals_sport(workout_type)
+    try:
+        workout_type = item['prospects'][0]['type']
+
+        # get_intervals_sport will get the intervals.icu name for SYSTM's equivalent sport
+        sport = get_intervals_sport(workout_type)
+
+        # Skip Mental Training workouts.
+        if workout_type == 'MentalTraining':
+            return None
+        # Non-ride workouts (run, strength, yoga) contain no information apart from duration and name, upload separately.
+        if sport != 'VirtualRide':
+            description = item['prospects'][0]['description']
+            moving_time = round(float(item['prospects'][0]['plannedDuration']) * 3600)
+
+            if sport == 'Yoga' and not athlete['UPLOAD_YOGA_WORKOUTS']:
+                return None
+            elif sport == 'WeightTraining' and not athlete['UPLOAD_STRENGTH_WORKOUTS']:
+                return None
+            elif sport == 'Run' and not athlete['UPLOAD_RUN_WORKOUTS']:
+                return None
+            elif sport == 'Swim' and not athlete['UPLOAD_SWIM_WORKOUTS']:
+                return None
+            else:
+                if workout_date_datetime >= today or athlete['UPLOAD_PAST_WORKOUTS']:
+                    payload = get_intervals_icu_payload(workout_date_string, workout_name, sport, description=description, moving_time=moving_time, external_id=external_id)
+                    return get_workout_upload(payload, state_key, workout_date_datetime, workout_name, sport, args, sync_state, events_by_id, events_by_key, deletions)
+                return None
 
-                # Skip Mental Training workouts.
-                if workout_type == 'MentalTraining':
-                    continue
-                # Non-ride workouts (run, strength, yoga) contain no information apart from duration and name, upload separately.
-                if sport != 'VirtualRide':
-                    description = item['prospects'][0]['description']
-                    moving_time = round(float(item['prospects'][0]['plannedDuration']) * 3600)
+    except Exception as err:
+        log(f'Error: {err}')
 
-                    if sport == 'Yoga' and not UPLOAD_YOGA_WORKOUTS:
-                        continue
-                    elif sport == 'WeightTraining' and not UPLOAD_STRENGTH_WORKOUTS:
-                        continue
-                    elif sport == 'Run' and not UPLOAD_RUN_WORKOUTS:
-                        continue
-                    elif sport == 'Swim' and not UPLOAD_SWIM_WORKOUTS:
-                        continue
-                    else:
-                        if workout_date_datetime >= today or UPLOAD_PAST_WORKOUTS:
-                            for event in events:
-                                if event['start_date_local'] == workout_date_datetime and event['name'] == workout_name:
-                                    print(f"Removing {workout_date_datetime}: {event['name']} (id {event['id']}).")
-                                    delete_intervals_icu_event(event['id'], INTERVALS_ICU_ID, INTERVALS_ICU_APIKEY)
-                            response = upload_to_intervals_icu(workout_date_string, workout_name, sport, INTERVALS_ICU_ID, INTERVALS_ICU_APIKEY, description=description, moving_time=moving_time)
-                            if response.status_code == 200:
-                                print(f'Uploaded {workout_date_datetime}: {workout_name} ({sport})')
-                            continue
+    # Get specific workout, fetched earlier by get_systm_workout_details()
+    if workout_detail is None:
+        log(f'No workout details found for {workout_name}, skipping.')
+        return None
 
-            except Exception as err:
-                print(f'Error: {err}')
+    try:
+        # Workout details contain nested JSON, so use clean_workout() to handle this.
+        workout_json = clean_workout(workout_detail)
+
+        if sport == 'VirtualRide':
+            sporttype = 'bike'
+
+        # If UPLOAD_DESCRIPTION is set, change description of workout to Wahoo SYSTM's description.
+        description = ''
+
+        # Escape XML from description
+        if athlete['UPLOAD_DESCRIPTION'] and workout_json['data']['workouts'][0]['details']:
+            description = workout_json['data']['workouts'][0]['details']
+            description = escape_xml(description)
+            # Replace 'km' in description, as intervals.icu uses it to show distance for an indoor workout.
+            description = description.replace("km", " kilometres")
+
+        # 'triggers' contains the FTP values for the workout
+        workout_json = workout_json['data']['workouts'][0]['triggers']
+
+        if not workout_json:
+            # Report missing workout data and move to the next workout
+            log(f'Workout {workout_name} does not contain any workout data.')
+            file_contents = 'No workout data found.'
+        else:
+            file_contents = build_zwo(workout_name, description, sporttype, workout_json, power_scales)
+
+        # Keep a copy of the .zwo file unless --no-files was provided.
+        if not args.no_files:
+            filename_zwo = os.path.join(zwo_dir, f'{filename}.zwo')
+            os.makedirs(zwo_dir, exist_ok=True)
+            with open(filename_zwo, 'w', encoding="utf-8") as f:
+                f.write(file_contents)
+
+        if not workout_json:
+            return None
 
-            # Get specific workout
-            workout_detail = get_systm_workout(SYSTM_URL, systm_token, workout_id)
+    except Exception as err:
+        log(f'{err}')
+        return None
 
-            # Create .zwo files with workout details
-            filename_zwo = f'./zwo/{filename}.zwo'
-            os.makedirs(os.path.dirname(filename_zwo), exist_ok=True)
+    try:
+        # Get filename, for upload to intervals.icu
+        intervals_filename = f'{workout_name_underscores}.zwo'
 
-            try:
-                # Workout details contain nested JSON, so use clean_workout() to handle this.
-                workout_json = clean_workout(workout_detail)
-
-                if sport == 'VirtualRide':
-                    sporttype = 'bike'
-
-                # If UPLOAD_DESCRIPTION is set, change description of workout to Wahoo SYSTM's description.
-                description = ''
-
-                # Escape XML from description
-                if UPLOAD_DESCRIPTION and workout_json['data']['workouts'][0]['details']:
-                    description = workout_json['data']['workouts'][0]['details']
-                    description = escape_xml(description)
-                    # Replace 'km' in description, as intervals.icu uses it to show distance for an indoor workout.
-                    description = description.replace("km", " kilometres")
-
-                # 'triggers' contains the FTP values for the workout
-                workout_json = workout_json['data']['workouts'][0]['triggers']
-
-                f = open(filename_zwo, "w", encoding="utf-8")
-                if not workout_json:
-                    # Report missing workout data and move to the next workout
-                    print(f'Workout {workout_name} does not contain any workout data.')
-                    f.write('No workout data found.')
-                    f.close()
-                    continue
-                else:
-                    text = f"""<workout_file>
-    <author></author>
-    <name>{workout_name}</name>
-    <description>{description}</description>
-    <sportType>{sporttype}</sportType>
-    <tags></tags>
-    <workout>"""
-                    f.write(text)
-
-                    for interval in range(len(workout_json)):
-                        for tracks in range(len(workout_json[interval]['tracks'])):
-                            for item in workout_json[interval]['tracks'][tracks]['objects']:
-                                power = None
-                                seconds = int(item['size'] / 1000)
-                                if 'ftp' in item['parameters']:
-                                    power = item['parameters']['ftp']['value']
-                                # Not sure if required, in my data this always seems to be the same as ftp
-                                if 'twentyMin' in item['parameters']:
-                                    twentyMin = item['parameters']['twentyMin']['value']
-                                    power = twentyMin
-                                    absolute_power = round(power * rider_ftp)
-                                # If map value exists, set ftp to the higher value of either map or ftp.
-                                if 'map' in item['parameters']:
-                                    map = item['parameters']['map']['value'] * round(rider_map / rider_ftp, 2)
-                                    power = map
-                                    absolute_power = round(power * rider_ftp)
-                                if 'ac' in item['parameters']:
-                                    ac = item['parameters']['ac']['value'] * round(rider_ac / rider_ftp, 2)
-                                    power = ac
-                                    absolute_power = round(power * rider_ftp)
-                                if 'nm' in item['parameters']:
-                                    nm = item['parameters']['nm']['value'] * round(rider_nm / rider_ftp, 2)
-                                    power = nm
-                                    absolute_power = round(power * rider_ftp)
-                                if power:
-                                    if 'rpm' in item['parameters']:
-                                        rpm = item['parameters']['rpm']['value']
-                                        text = f'\n\t\t<SteadyState show_avg="1" Cadence="{rpm}" Power="{power}" Duration="{seconds}"/><!-- abs power: {absolute_power} -->'
-                                    else:
-                                        text = f'\n\t\t<SteadyState show_avg="1" Power="{power}" Duration="{seconds}"/><!-- abs power: {absolute_power} -->'
-                                    f.write(text)
-                    text = r"""
-    </workout>
-</workout_file>"""
-                    f.write(text)
+        if workout_date_datetime >= today or athlete['UPLOAD_PAST_WORKOUTS']:
+            # Rider profile changes end up in the .zwo file, so they're detected by the content hash as well.
+            payload = get_intervals_icu_payload(workout_date_string, intervals_filename, sport, contents=file_contents, external_id=external_id)
+            return get_workout_upload(payload, state_key, workout_date_datetime, workout_name, sport, args, sync_state, events_by_id, events_by_key, deletions)
+    except Exception as err:
+        log(f'Something went wrong: {err}')
+    return None
+
+
+def get_stale_events(deletions, plan_keys, start_date, end_date, sync_state, events_by_id):
+    """Add events of workouts that were moved to another date or removed from the plan since the last sync to deletions, return their sync state keys."""
+    stale_keys = []
+    for (planned_date, workout_id), (content_hash, event_id) in sync_state.items():
+        if (planned_date, workout_id) in plan_keys or not start_date <= planned_date <= end_date:
+            continue
+        if event_id in events_by_id:
+            deletions[int(event_id)] = f'{planned_date}: workout no longer in plan (id {event_id})'
+        stale_keys.append((planned_date, workout_id))
+    return stale_keys
+
+
+def remove_replaced_events(deletions, stale_keys, athlete, settings, sync_state_db):
+    """Delete replaced events and events of workouts that are no longer in the plan, remove those workouts from the sync state."""
+    if deletions:
+        deleted = remove_intervals_icu_events(list(deletions), athlete['INTERVALS_ICU_ID'], athlete['INTERVALS_ICU_APIKEY'], settings['BULK_UPLOAD_SIZE'], settings['MAX_CONCURRENT_REQUESTS'])
+        for event_id, label in deletions.items():
+            if event_id in deleted:
+                log(f'Removed {label}.')
+    for planned_date, workout_id in stale_keys:
+        remove_sync_state(sync_state_db, athlete['INTERVALS_ICU_ID'], planned_date, workout_id)
+
+
+def get_sync_changes(uploads, deletions, existing_events, events_by_id):
+    """Return events that a sync creates, updates and deletes in intervals.icu."""
+    changes = []
+    for upload in uploads:
+        payload = upload['payload']
+        event_id = existing_events.get(payload.get('external_id'))
+        changes.append({
+            'athlete': log_athlete.get(),
+            'action': 'create' if event_id is None else 'update',
+            'date': payload['start_date_local'][:10],
+            'name': payload.get('name') or payload.get('filename'),
+            'type': payload['type'],
+            'event_id': event_id,
+            'external_id': payload.get('external_id'),
+            'label': upload['label']
+        })
+    for event_id, label in deletions.items():
+        event = events_by_id.get(str(event_id), {})
+        changes.append({
+            'athlete': log_athlete.get(),
+            'action': 'delete',
+            'date': str(event['start_date_local']) if event else None,
+            'name': event.get('name'),
+            'type': None,
+            'event_id': event_id,
+            'external_id': event.get('external_id'),
+            'label': label
+        })
+    return changes
+
+
+def report_sync_changes(changes, diff_file=None):
+    """Print events a sync would create, update and delete, and append them to diff_file."""
+    for change in changes:
+        log(f"Would {change['action']} {change['label']}")
+    counts = {action: sum(change['action'] == action for change in changes) for action in ('create', 'update', 'delete')}
+    log(f"Dry run: {counts['create']} events to create, {counts['update']} to update and {counts['delete']} to delete.")
+    if diff_file:
+        write_sync_changes(diff_file, changes)
+
+
+def write_sync_changes(diff_file, changes):
+    """Append changes of a dry run to diff_file as JSON lines."""
+    with diff_file_lock, open(diff_file, 'a', encoding='utf-8') as f:
+        for change in changes:
+            f.write(json.dumps(change) + '\n')
+
+
+def record_uploads(uploads, event_ids, athlete, sync_state_db):
+    """Store uploaded workouts in the sync state."""
+    for upload, event_id in zip(uploads, event_ids):
+        if event_id is not None:
+            planned_date, workout_id = upload['state_key']
+            update_sync_state(sync_state_db, athlete['INTERVALS_ICU_ID'], planned_date, workout_id, upload['content_hash'], event_id)
+            log(f"Uploaded {upload['label']}")
+
+
+def sync_athlete(athlete, settings, args):
+    """Sync Wahoo SYSTM training plan of an athlete with intervals.icu."""
+    if args.use_async and not args.delete and not args.dry_run:
+        asyncio.run(sync_athlete_async(athlete, settings, args))
+        return
+
+    SYSTM_URL = settings['SYSTM_URL']
+    SYSTM_USERNAME = athlete['SYSTM_USERNAME']
+    SYSTM_PASSWORD = athlete['SYSTM_PASSWORD']
+    START_DATE = args.start_date or athlete['START_DATE']
+    END_DATE = args.end_date or athlete['END_DATE']
+    INTERVALS_ICU_ID = athlete['INTERVALS_ICU_ID']
+    INTERVALS_ICU_APIKEY = athlete['INTERVALS_ICU_APIKEY']
+    BULK_UPLOAD_SIZE = settings['BULK_UPLOAD_SIZE']
+    MAX_CONCURRENT_REQUESTS = settings['MAX_CONCURRENT_REQUESTS']
+    PLAN_WINDOW_DAYS = settings['PLAN_WINDOW_DAYS']
+    CACHE_DIR = settings['CACHE_DIR']
+    CACHE_TTL_DAYS = settings['CACHE_TTL_DAYS']
+    CACHE_MAX_SIZE_MB = settings['CACHE_MAX_SIZE_MB']
+    STATE_FILE = settings['STATE_FILE']
+    TOKEN_FILE = settings['TOKEN_FILE']
+    TOKEN_TTL_HOURS = settings['TOKEN_TTL_HOURS']
+    # Athletes get their own .zwo directory, their files differ even for the same workout.
+    ZWO_DIR = os.path.join(settings['ZWO_DIR'], athlete['name']) if athlete['name'] else settings['ZWO_DIR']
 
-            except Exception as err:
-                print(f'{err}')
+    # Get Wahoo SYSTM auth token
+    systm_token, rider_profile = get_systm_login(SYSTM_URL, SYSTM_USERNAME, SYSTM_PASSWORD, TOKEN_FILE, TOKEN_TTL_HOURS, refresh=args.refresh)
 
-            f.close()
+    # Get Wahoo SYSTM workouts from training plan, log in again if the cached token isn't valid anymore.
+    # Long date ranges are split in windows that are fetched in parallel.
+    try:
+        try:
+            workouts = get_systm_plan(SYSTM_URL, systm_token, START_DATE, END_DATE, PLAN_WINDOW_DAYS, MAX_CONCURRENT_REQUESTS)
+        except SystmAuthError:
+            log('Wahoo SYSTM token expired, logging in again.')
+            systm_token, rider_profile = get_systm_login(SYSTM_URL, SYSTM_USERNAME, SYSTM_PASSWORD, TOKEN_FILE, TOKEN_TTL_HOURS, refresh=True)
+            workouts = get_systm_plan(SYSTM_URL, systm_token, START_DATE, END_DATE, PLAN_WINDOW_DAYS, MAX_CONCURRENT_REQUESTS)
+    except SystmError as err:
+        log(f'Wahoo SYSTM Error: {err}')
+        sys.exit(1)
 
+    # Power targets in the .zwo files depend on the 4DP profile of the athlete.
+    power_scales = get_power_scales(rider_profile)
+
+    # Retrieve all intervals.icu workouts for the date range
+    response = get_intervals_icu_events(START_DATE, END_DATE, INTERVALS_ICU_ID, INTERVALS_ICU_APIKEY)
+    events = get_intervals_icu_event_list(response.json())
+
+    # Keep track of uploaded workouts, only changed workouts get uploaded again.
+    sync_state_db = open_sync_state(STATE_FILE)
+    try:
+        sync_state = get_sync_state(sync_state_db, INTERVALS_ICU_ID)
+
+        # Index events so matching workouts to existing events doesn't need to go through all events for every workout.
+        events_by_id, events_by_key = index_intervals_icu_events(events)
+
+        # If -d/--delete CLI argument was provided, delete the selected events.
+        if args.delete:
+            categories = {category.strip().upper() for category in args.category.split(',')} if args.category else None
+            name_pattern = re.compile(args.name) if args.name else None
+            selected = [event for event in events if (not categories or event['category'] in categories) and (not name_pattern or name_pattern.search(event['name']))]
+            for event in selected:
+                log(f"{'Would delete' if args.dry_run else 'Deleting'} {event['category'].lower() if event['category'] else 'event'} {event['name']} on {event['start_date_local']}")
+            if args.dry_run:
+                log(f'{len(selected)} of {len(events)} events would be deleted.')
+                if args.diff:
+                    deletions = {event['id']: f"{event['start_date_local']}: {event['name']} (id {event['id']})" for event in selected}
+                    write_sync_changes(args.diff, get_sync_changes([], deletions, {}, events_by_id))
+                return
+
+            start = time.perf_counter()
+            deleted = remove_intervals_icu_events([event['id'] for event in selected], INTERVALS_ICU_ID, INTERVALS_ICU_APIKEY, BULK_UPLOAD_SIZE, MAX_CONCURRENT_REQUESTS)
+            deleted = {str(event_id) for event_id in deleted}
+            for (planned_date, workout_id), (content_hash, event_id) in sync_state.items():
+                if event_id in deleted:
+                    remove_sync_state(sync_state_db, INTERVALS_ICU_ID, planned_date, workout_id)
+            log(f'Deleted {len(deleted)} of {len(selected)} events in {time.perf_counter() - start:.2f}s, start suffersync again without any arguments.')
+            return
+
+        # Ride workouts need their interval details, fetch these for the whole plan up front.
+        ride_workout_ids = [item['prospects'][0]['workoutId'] for item in workouts if item['plannedDate'] and item['prospects'][0]['type'] == 'Cycling']
+        # Workout details hardly ever change, only download the ones that aren't cached yet.
+        workout_details = {} if args.refresh else get_cached_workouts(CACHE_DIR, ride_workout_ids, CACHE_TTL_DAYS)
+        if workout_details:
+            log(f'Loaded {len(workout_details)} workouts from cache')
+        missing_workout_ids = [workout_id for workout_id in ride_workout_ids if workout_id not in workout_details]
+        fetched_details = get_systm_workout_details(SYSTM_URL, systm_token, missing_workout_ids, MAX_CONCURRENT_REQUESTS)
+        for workout_id, workout_detail in fetched_details.items():
+            if workout_detail is not None:
+                store_cached_workout(CACHE_DIR, workout_id, workout_detail)
+        prune_workout_cache(CACHE_DIR, CACHE_MAX_SIZE_MB * 1024 * 1024)
+        workout_details.update(fetched_details)
+
+        # Workouts in the current plan, used to find workouts that were moved or removed since the last sync.
+        plan_keys = set()
+        # New and changed workouts, uploaded in bulk once all workouts are processed.
+        uploads = []
+        # Existing events that get replaced or are no longer in the plan, deleted in bulk before uploading.
+        deletions = {}
+
+        # For each workout, make sure there's a "plannedDate" field to avoid bogus entries.
+        for item in workouts:
+            if item['plannedDate']:
+                plan_keys.add(get_plan_key(item))
+                workout_detail = workout_details.get(item['prospects'][0]['workoutId'])
+                upload = prepare_workout(item, workout_detail, athlete, args, ZWO_DIR, power_scales, sync_state, events_by_id, events_by_key, deletions)
+                if upload is not None:
+                    uploads.append(upload)
+
+        stale_keys = get_stale_events(deletions, plan_keys, START_DATE, END_DATE, sync_state, events_by_id)
+        existing_events = {event['external_id']: event['id'] for event in events if event['external_id']}
+
+        # With -n/--dry-run, only show what would change in intervals.icu.
+        if args.dry_run:
+            report_sync_changes(get_sync_changes(uploads, deletions, existing_events, events_by_id), args.diff)
+            return
+
+        remove_replaced_events(deletions, stale_keys, athlete, settings, sync_state_db)
+
+        # Upload all new and changed workouts in as few requests as possible.
+        uploaded_event_ids = upload_events_to_intervals_icu([upload['payload'] for upload in uploads], INTERVALS_ICU_ID, INTERVALS_ICU_APIKEY, BULK_UPLOAD_SIZE, existing_events)
+        record_uploads(uploads, uploaded_event_ids, athlete, sync_state_db)
+    finally:
+        sync_state_db.close()
+
+
+async def sync_athlete_async(athlete, settings, args):
+    """Sync Wahoo SYSTM training plan of an athlete with intervals.icu as a pipeline of concurrent stages.
+
+    Plan windows, workout details, rendering and uploads overlap: workouts are passed on through bounded queues
+    as soon as they're available instead of waiting for the previous stage to finish for the whole plan.
+    """
+    SYSTM_URL = settings['SYSTM_URL']
+    START_DATE = args.start_date or athlete['START_DATE']
+    END_DATE = args.end_date or athlete['END_DATE']
+    INTERVALS_ICU_ID = athlete['INTERVALS_ICU_ID']
+    INTERVALS_ICU_APIKEY = athlete['INTERVALS_ICU_APIKEY']
+    BULK_UPLOAD_SIZE = max(1, settings['BULK_UPLOAD_SIZE'])
+    MAX_CONCURRENT_REQUESTS = max(1, settings['MAX_CONCURRENT_REQUESTS'])
+    CACHE_DIR = settings['CACHE_DIR']
+    CACHE_TTL_DAYS = settings['CACHE_TTL_DAYS']
+    ZWO_DIR = os.path.join(settings['ZWO_DIR'], athlete['name']) if athlete['name'] else settings['ZWO_DIR']
+    loop = asyncio.get_running_loop()
+
+    login = {}
+    plan_queue = asyncio.Queue(maxsize=MAX_CONCURRENT_REQUESTS * 4)
+    upload_queue = asyncio.Queue(maxsize=BULK_UPLOAD_SIZE * 2)
+    request_limit = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    detail_tasks = {}
+    plan_keys = set()
+    deletions = {}
+    stopped = Event()
+
+    def produce_plan():
+        """Fetch plan windows in a thread and put their workouts on the plan queue as windows complete."""
+        done = set()
+        for attempt in range(2):
             try:
-                # Get filename, for upload to intervals.icu
-                intervals_filename = f'{filename_zwo[17:]}'
-
-                # Open .zwo file and read contents
-                zwo_file = open(filename_zwo, 'r', encoding="utf-8")
-                file_contents = zwo_file.read()
-
-                if workout_date_datetime >= today or UPLOAD_PAST_WORKOUTS:
-                    for event in events:
-                        if event['start_date_local'] == workout_date_datetime and (event['name'] == workout_name or event['name'] == workout_name_remove_invalid_chars):
-                            print(f"Removing {workout_date_datetime}: {event['name']} (id {event['id']}).")
-                            delete_intervals_icu_event(event['id'], INTERVALS_ICU_ID, INTERVALS_ICU_APIKEY)
-                    response = upload_to_intervals_icu(workout_date_string, intervals_filename, sport, INTERVALS_ICU_ID, INTERVALS_ICU_APIKEY, contents=file_contents)
-                    if response.status_code == 200:
-                        print(f'Uploaded {workout_date_datetime}: {workout_name} ({sport})')
-
-                zwo_file.close()
+                for window_start, workouts in iter_systm_workouts(SYSTM_URL, login['token'], START_DATE, END_DATE, settings['PLAN_WINDOW_DAYS'], MAX_CONCURRENT_REQUESTS):
+                    if window_start in done:
+                        continue
+                    done.add(window_start)
+                    for item in workouts:
+                        if stopped.is_set():
+                            return
+                        asyncio.run_coroutine_threadsafe(plan_queue.put(item), loop).result()
+                return
+            except SystmError as err:
+                if attempt or not isinstance(err, SystmAuthError):
+                    log(f'Wahoo SYSTM Error: {err}')
+                    sys.exit(1)
+                log('Wahoo SYSTM token expired, logging in again.')
+                login['token'], login['profile'] = get_systm_login(SYSTM_URL, athlete['SYSTM_USERNAME'], athlete['SYSTM_PASSWORD'], settings['TOKEN_FILE'], settings['TOKEN_TTL_HOURS'], refresh=True)
+                # The 4DP profile may have changed since the cached login, the workers render with the new one.
+                login['power_scales'] = get_power_scales(login['profile'])
+
+    async def fetch_detail(workout_id):
+        """Return workout details from the cache or Wahoo SYSTM."""
+        if not args.refresh:
+            cached = await asyncio.to_thread(get_cached_workouts, CACHE_DIR, [workout_id], CACHE_TTL_DAYS)
+            if workout_id in cached:
+                return cached[workout_id]
+        async with request_limit:
+            start = time.perf_counter()
+            try:
+                detail = await asyncio.to_thread(get_systm_workout, SYSTM_URL, login['token'], workout_id)
             except Exception as err:
-                print(f'Something went wrong: {err}')
+                log(f'Error fetching workout {workout_id}: {err}')
+                return None
+            log(f'Fetched workout {workout_id} in {time.perf_counter() - start:.2f}s')
+        await asyncio.to_thread(store_cached_workout, CACHE_DIR, workout_id, detail)
+        return detail
+
+    async def process_plan():
+        """Get details of workouts on the plan queue, render them and put the uploads on the upload queue."""
+        while True:
+            item = await plan_queue.get()
+            if item is None:
+                # Let the other workers stop as well.
+                await plan_queue.put(None)
+                return
+            if not item['plannedDate']:
+                continue
+            plan_keys.add(get_plan_key(item))
+            workout_detail = None
+            if item['prospects'][0]['type'] == 'Cycling':
+                # A workout can be in the plan more than once, only fetch it once.
+                workout_id = item['prospects'][0]['workoutId']
+                if workout_id not in detail_tasks:
+                    detail_tasks[workout_id] = asyncio.ensure_future(fetch_detail(workout_id))
+                workout_detail = await detail_tasks[workout_id]
+            upload = prepare_workout(item, workout_detail, athlete, args, ZWO_DIR, login['power_scales'], sync_state, events_by_id, events_by_key, deletions)
+            if upload is not None:
+                await upload_queue.put(upload)
+
+    async def upload_workouts():
+        """Upload workouts from the upload queue in chunks as they fill up."""
+        done = False
+        while not done:
+            chunk = []
+            while len(chunk) < BULK_UPLOAD_SIZE:
+                upload = await upload_queue.get()
+                if upload is None:
+                    done = True
+                    break
+                chunk.append(upload)
+            if chunk:
+                event_ids = await asyncio.to_thread(upload_events_to_intervals_icu, [upload['payload'] for upload in chunk], INTERVALS_ICU_ID, INTERVALS_ICU_APIKEY, BULK_UPLOAD_SIZE, existing_events)
+                uploaded.update(event_id for event_id in event_ids if event_id is not None)
+                record_uploads(chunk, event_ids, athlete, sync_state_db)
+
+    async def finish_stages():
+        """Stop the workers once the plan is complete and the uploader once the workers are done."""
+        await producer
+        await plan_queue.put(None)
+        await asyncio.gather(*workers)
+        await upload_queue.put(None)
+        await uploader
+
+    # intervals.icu events don't depend on Wahoo SYSTM, fetch them while logging in and fetching the plan.
+    events_task = asyncio.create_task(asyncio.to_thread(get_intervals_icu_events, START_DATE, END_DATE, INTERVALS_ICU_ID, INTERVALS_ICU_APIKEY))
+    producer = None
+    stages = []
+    sync_state_db = None
+    try:
+        login['token'], login['profile'] = await asyncio.to_thread(get_systm_login, SYSTM_URL, athlete['SYSTM_USERNAME'], athlete['SYSTM_PASSWORD'], settings['TOKEN_FILE'], settings['TOKEN_TTL_HOURS'], args.refresh)
+        # Power targets in the .zwo files depend on the 4DP profile of the athlete.
+        login['power_scales'] = get_power_scales(login['profile'])
+
+        sync_state_db = open_sync_state(settings['STATE_FILE'])
+        sync_state = get_sync_state(sync_state_db, INTERVALS_ICU_ID)
+
+        # Start fetching the plan, its workouts are queued until the intervals.icu events are in.
+        producer = asyncio.create_task(asyncio.to_thread(produce_plan))
+        response = await events_task
+        events = get_intervals_icu_event_list(response.json())
+        events_by_id, events_by_key = index_intervals_icu_events(events)
+        existing_events = {event['external_id']: event['id'] for event in events if event['external_id']}
+        uploaded = set()
+        uploader = asyncio.create_task(upload_workouts())
+        workers = [asyncio.create_task(process_plan()) for _ in range(MAX_CONCURRENT_REQUESTS)]
+        stages = [uploader, *workers, asyncio.create_task(finish_stages())]
+        # A failing stage stops the others, they would otherwise wait forever on its queue.
+        done, pending = await asyncio.wait(stages, return_when=asyncio.FIRST_EXCEPTION)
+        for task in done:
+            if task.exception() is not None:
+                raise task.exception()
+    except BaseException:
+        for task in [events_task, *stages, *detail_tasks.values()]:
+            task.cancel()
+        await asyncio.gather(events_task, *stages, *detail_tasks.values(), return_exceptions=True)
+        # Unblock the plan thread, it may be waiting for room on the plan queue.
+        stopped.set()
+        while producer is not None and not producer.done():
+            while not plan_queue.empty():
+                plan_queue.get_nowait()
+            await asyncio.sleep(0.05)
+        if sync_state_db is not None:
+            sync_state_db.close()
+        raise
+
+    try:
+        # Events are deleted once everything is uploaded, keep the ones that were updated by the upload.
+        for event_id in uploaded:
+            deletions.pop(event_id, None)
+        await asyncio.to_thread(prune_workout_cache, CACHE_DIR, settings['CACHE_MAX_SIZE_MB'] * 1024 * 1024)
+        # The sync state connection can only be used from this thread.
+        stale_keys = get_stale_events(deletions, plan_keys, START_DATE, END_DATE, sync_state, events_by_id)
+        remove_replaced_events(deletions, stale_keys, athlete, settings, sync_state_db)
+    finally:
+        sync_state_db.close()
 
 
 if __name__ == "__main__":